@@ -1,8 +1,8 @@
 import math
 import numpy as np
-from root_numpy import root2array
 from scipy.sparse import lil_matrix, find
 from scipy.spatial.distance import pdist, squareform
+from readers import get_reader
 
 """
 Notation used below:
@@ -371,8 +371,17 @@ class CDC(CylindricalArray):
         # Build the cylindrical array
         CylindricalArray.__init__(self, point_x, point_y, layer_id)
 
-        # Give it a recbe wiring
-        self.recbe = RECBE(self)
+        # Give it a recbe wiring, read from the channel map when first used
+        self._recbe = None
+
+    @property
+    def recbe(self):
+        """
+        Returns the RECBE board geometry of the CDC
+        """
+        if self._recbe is None:
+            self._recbe = RECBE(self)
+        return self._recbe
 
     def theta_at_rel_z(self, z_dist, total_z=1.0):
         """
@@ -461,9 +470,9 @@ class CTH(CylindricalArray):
     def _get_channel_bits(self, channel):
         """
         Get the integer representation of the 10 most significant bits of the
-        channel id
+        25 bit channel id.  Works on single channels and on arrays of channels.
         """
-        return int("{0:025b}".format(channel)[:10], 2)
+        return np.right_shift(channel, 15) & 0x3FF
 
     def chan_to_row(self, channel):
         """
@@ -476,6 +485,8 @@ class CTH(CylindricalArray):
                 Cherenkov counters and LG : 2
                 Scintillators             : 3
                 Scintillator LG           : 4
+
+        Works on single channels and on arrays of channels.
         """
         # Mask out the CTH channel bits
         trimmed_channel = self._get_channel_bits(channel)
@@ -486,27 +497,27 @@ class CTH(CylindricalArray):
         # Next bit is scintillator mask
         is_sc_mask = 1 << 1
         # Map downstream to rows [3-5]
-        row_offset = 0
-        if not trimmed_channel & is_upstream:
-            row_offset = 2
-        # Map both cherenkov light guide and cherenkov counter to same volume
-        if not trimmed_channel & is_sc_mask:
-            return 0 + row_offset
-        # Map the scintillator to the next row
-        elif not trimmed_channel & is_lg_mask:
-            return 1 + row_offset
-        # Ignore the scintillator light guide
-        return 4
+        row_offset = np.where(trimmed_channel & is_upstream, 0, 2)
+        # Map both cherenkov light guide and cherenkov counter to same volume,
+        # the scintillator to the next row, and ignore the scintillator light
+        # guide
+        rows = np.where(trimmed_channel & is_sc_mask,
+                        np.where(trimmed_channel & is_lg_mask,
+                                 4, 1 + row_offset),
+                        0 + row_offset)
+        # Return a scalar for a single channel
+        return rows[()]
 
     def chan_to_module(self, channel):
         """
-        Return upstream or downstream module flag from channel ID
+        Return upstream or downstream module flag from channel ID.  Works on
+        single channels and on arrays of channels.
         """
         # Mask out the CTH channel bits
         trimmed_channel = self._get_channel_bits(channel)
         # LSB is light guide boolean mask
         is_upstream = 1 << 9
-        return bool(trimmed_channel & is_upstream)
+        return np.asarray(trimmed_channel & is_upstream, dtype=bool)[()]
 
 
     def _prepare_dphi_by_layer(self, n_by_layer):
@@ -555,7 +566,7 @@ class TrackCenters(CylindricalArray):
         CylindricalArray.__init__(self, point_x, point_y, layer_id)
 
 class RECBE(CylindricalArray):
-    def __init__(self, cdc, file_name=None):
+    def __init__(self, cdc, file_name=None, reader=None):
         # Default file name
         recbe_file = "/home/five4three2/development/ICEDUST/"+\
                      "track-finding-yandex/data/chanmap_20160814.root"
@@ -567,9 +578,10 @@ class RECBE(CylindricalArray):
             recbe_file = file_name
         # Get the sense wires
         selection = "isSenseWire == 1 && LayerID > 0 && LayerID < 19"
-        recbe_arr = root2array(recbe_file, selection=selection,
-                               branches=["LayerID", "CellID", "BoardID",
-                                         "BrdLayID", "BrdLocID", "ChanID"])
+        recbe_arr = get_reader(reader).read(recbe_file, selection=selection,
+                                            branches=["LayerID", "CellID",
+                                                      "BoardID", "BrdLayID",
+                                                      "BrdLocID", "ChanID"])
         recbe_arr["LayerID"] = recbe_arr["LayerID"] - 1
         # Get the board mapping
         self.wire_to_board = recbe_arr["BoardID"][cdc.point_lookup[\
@@ -0,0 +1,290 @@
+import numpy as np
+"""
+Container for the hit data held by the hit classes
+"""
+
+# Largest number of distinct values of a column with a bitmap index
+MAX_BITMAP_VALUES = 64
+
+class HitData(object):
+    """
+    Columnar container of hit data.  Each column is its own contiguous numpy
+    array, and the container is indexed like a record array:
+
+     - data[name] returns the column, which can be modified in place, e.g.
+       data[name][idx] = value
+     - data[mask], data[indexes] and data[start:stop] return a new container
+       with every column selected, where slices are views
+     - data[[name, ...]] returns a container of only these columns
+     - data[idx] returns a dictionary of the values of a single hit
+
+    It also reads as a mapping of name to column through keys, items and
+    iteration over the names.  Use to_records for code that needs a record
+    array, e.g. pandas.DataFrame(data.to_records()).
+
+    Lazy columns are named in lazy_names, and are requested from
+    loader(name, rows) the first time they are accessed, which returns the
+    column for the given rows of the hit data.
+
+    If on_change is set, on_change(name) is called whenever a column is
+    assigned, added or removed through the container, including
+    data[name] += value.  It is passed on to the views of the same columns,
+    i.e. slices and sub sets of the columns, but not to copies.  Changes made
+    directly to a column, e.g. data[name][idx] = value, are not seen.
+    """
+    def __init__(self, columns=None, names=None, lazy_names=(), loader=None,
+                 on_change=None):
+        """
+        :param columns: list of columns, or dictionary of name to column
+        :param names: names of the columns when columns is a list
+        :param lazy_names: names of the lazy columns
+        :param loader: function that returns the lazy columns
+        :param on_change: function called with the name of a changed column
+        """
+        if columns is None:
+            columns = dict()
+        if names is not None:
+            columns = zip(names, columns)
+        self._columns = dict()
+        for name, column in dict(columns).items():
+            self._columns[name] = np.asarray(column)
+        self.lazy_names = tuple(lazy_names)
+        self.loader = loader
+        self.on_change = on_change
+
+    def _new(self, columns, is_view=False):
+        """
+        Returns a container of these columns that shares the lazy columns,
+        and that reports its changes if it is a view of these columns
+        """
+        return HitData(columns, lazy_names=self.lazy_names, loader=self.loader,
+                       on_change=self.on_change if is_view else None)
+
+    def _changed(self, name):
+        """
+        Report a change to the column
+        """
+        if self.on_change is not None:
+            self.on_change(name)
+
+    @property
+    def names(self):
+        """
+        Names of the columns in the order they were added
+        """
+        return tuple(self._columns)
+
+    @property
+    def dtype(self):
+        """
+        Record dtype of the columns, for compatibility with record arrays
+        """
+        return np.dtype([(name, column.dtype)
+                         for name, column in self._columns.items()])
+
+    @property
+    def nbytes(self):
+        """
+        Total size of the columns in bytes
+        """
+        return sum(column.nbytes for column in self._columns.values())
+
+    def __len__(self):
+        if not self._columns:
+            return 0
+        return len(next(iter(self._columns.values())))
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def keys(self):
+        """
+        Returns the names of the columns, as for a dictionary
+        """
+        return self._columns.keys()
+
+    def items(self):
+        """
+        Returns pairs of name and column, as for a dictionary
+        """
+        return self._columns.items()
+
+    def __repr__(self):
+        return "HitData({} hits, columns={})".format(len(self),
+                                                    list(self._columns))
+
+    def __getitem__(self, key):
+        # Get a column by name
+        if isinstance(key, str):
+            if key not in self._columns and key in self.lazy_names:
+                return self.loader(key, self)
+            return self._columns[key]
+        # Get a sub set of the columns
+        if isinstance(key, list) and key and isinstance(key[0], str):
+            return self._new(dict((name, self._columns[name])
+                                  for name in key), is_view=True)
+        # Get a single hit
+        if isinstance(key, (int, np.integer)):
+            return dict((name, column[key])
+                        for name, column in self._columns.items())
+        # Otherwise select the same hits in every column, where only slices
+        # are views
+        return self._new(dict((name, column[key])
+                              for name, column in self._columns.items()),
+                         is_view=isinstance(key, slice))
+
+    def __setitem__(self, key, value):
+        if isinstance(key, str):
+            # Fill existing columns in place, as with a record array
+            if key in self._columns:
+                self._columns[key][...] = value
+                self._changed(key)
+            else:
+                self.add_column(key, value)
+            return
+        # Otherwise set the selected hits of every column
+        for name, column in self._columns.items():
+            column[key] = value[name]
+            self._changed(name)
+
+    def add_column(self, name, values):
+        """
+        Add a column, broadcasting single values to every hit
+        """
+        values = np.asarray(values)
+        if values.ndim == 0:
+            values = np.full(len(self), values)
+        assert not self._columns or len(values) == len(self),\
+            "ERROR: column {} has {} entries for {} hits".format(name,
+                                                                len(values),
+                                                                len(self))
+        self._columns[name] = values
+        self._changed(name)
+
+    def remove_columns(self, names):
+        """
+        Remove the named columns
+        """
+        if not isinstance(names, list):
+            names = [names]
+        for name in names:
+            if self._columns.pop(name, None) is not None:
+                self._changed(name)
+
+    def cast_columns(self, dtypes):
+        """
+        Convert the named columns to the given dtypes, without copying the
+        columns already of that dtype
+
+        :param dtypes: dictionary of column name to dtype
+        """
+        for name, dtype in dtypes.items():
+            if name in self._columns:
+                self._columns[name] = self._columns[name].astype(dtype,
+                                                                 copy=False)
+
+    def copy(self):
+        """
+        Returns a copy of the container with copies of every column
+        """
+        return self._new(dict((name, column.copy())
+                              for name, column in self._columns.items()))
+
+    def to_records(self):
+        """
+        Returns the data as a numpy record array
+        """
+        return np.rec.fromarrays(list(self._columns.values()),
+                                 names=list(self._columns))
+
+    @staticmethod
+    def concatenate(all_data):
+        """
+        Returns the hits of each container one after the other, keeping the
+        columns of the first container
+        """
+        first = all_data[0]
+        return first._new(dict((name, np.concatenate([data[name]
+                                                      for data in all_data]))
+                               for name in first.names))
+
+def _read_bits(bitmap, hit_indexes):
+    """
+    Returns the bits of a packed bitmap at the hit indexes, stored most
+    significant bit first, without unpacking the rest of the bitmap
+    """
+    shifts = (7 - (hit_indexes & 7)).astype(np.uint8)
+    return np.right_shift(bitmap[hit_indexes >> 3], shifts) & 1
+
+class BitmapIndex(object):
+    """
+    Secondary index of a categorical column of the hit data, holding a packed
+    bitmap of the hits that take each value of the column.  Selections of one
+    or more values are then the bitwise or of their bitmaps, read only at the
+    hits of interest.  The index takes one bit per hit for each value, so only
+    columns with at most max_values distinct values can be indexed.
+    """
+    def __init__(self, column=None, max_values=MAX_BITMAP_VALUES):
+        """
+        :param column: categorical column to index
+        :param max_values: largest number of distinct values to index
+        """
+        if column is None:
+            column = np.zeros(0)
+        column = np.asarray(column)
+        self.n_hits = len(column)
+        self.values = np.unique(column)
+        assert len(self.values) <= max_values,\
+            "ERROR: column has {} distinct values, ".format(len(self.values))+\
+            "more than the {} a bitmap index can hold".format(max_values)
+        self.bits = np.zeros((len(self.values), (self.n_hits + 7) // 8),
+                             dtype=np.uint8)
+        for row, value in enumerate(self.values):
+            self.bits[row] = np.packbits(column == value)
+
+    def get_bitmap(self, values):
+        """
+        Returns the packed bitmap of the hits taking any of the values
+        """
+        rows = np.flatnonzero(np.isin(self.values, values))
+        return np.bitwise_or.reduce(self.bits[rows], axis=0,
+                                    initial=np.uint8(0))
+
+    def get_mask(self, values, hit_indexes=None, invert=False):
+        """
+        Returns the boolean mask of the hits taking any of the values
+
+        :param values: value or list of values to select
+        :param hit_indexes: only return the mask of the hits at these indexes,
+                            default is all the hits
+        :param invert: select the hits that do not take any of the values
+        """
+        bitmap = self.get_bitmap(values)
+        if invert:
+            bitmap = np.invert(bitmap)
+        if hit_indexes is None:
+            return np.unpackbits(bitmap, count=self.n_hits).astype(bool)
+        return _read_bits(bitmap, np.asarray(hit_indexes)).astype(bool)
+
+    def take(self, hits):
+        """
+        Returns the index of the selected hits, in the order selected, to
+        follow a trim or a sort of the data.  The bits of the selected hits
+        are read from each packed bitmap in turn.
+
+        :param hits: boolean mask or indexes of the hits to keep
+        """
+        hits = np.asarray(hits)
+        if hits.dtype == bool:
+            hits = np.flatnonzero(hits)
+        index = BitmapIndex()
+        index.n_hits = len(hits)
+        index.values = self.values
+        index.bits = np.zeros((len(self.values), (index.n_hits + 7) // 8),
+                              dtype=np.uint8)
+        for row, bitmap in enumerate(self.bits):
+            index.bits[row] = np.packbits(_read_bits(bitmap, hits))
+        return index
@@ -1,6 +1,15 @@
+import os
+import copy
+import json
+import inspect
+import warnings
+from contextlib import contextmanager
 import numpy as np
-from root_numpy import root2array
 from cylinder import CDC, CTH
+from import_cache import CachedImport
+from readers import get_reader
+from hit_data import HitData, BitmapIndex
+from query import HitPredicate, HitQuery, get_selection_names
 """
 Notation used below:
  - wire_id is flat enumerator of all wires
@@ -18,9 +27,154 @@ def _return_branches_as_list(branches):
         branches = [branches]
     return branches
 
-class FlatHits(object):
+# Geometries that saved hit objects can be rebuilt with
+GEOMETRIES = {"CDC" : CDC, "CTH" : CTH}
+
+def _json_attributes(obj):
+    """
+    Returns the attributes of the object that can be stored as json metadata,
+    skipping arrays and other objects
+    """
+    attributes = dict()
+    for name, value in obj.__dict__.items():
+        # Store numpy scalars as python scalars
+        if isinstance(value, np.generic):
+            value = value.item()
+        try:
+            json.dumps(value)
+        except TypeError:
+            continue
+        attributes[name] = value
+    return attributes
+
+def _write_metadata(path, meta):
+    """
+    Write the metadata of a saved hit object to path/meta.json
+    """
+    with open(os.path.join(path, "meta.json"), "w") as meta_file:
+        json.dump(meta, meta_file, indent=1)
+
+def _read_metadata(path, cls):
+    """
+    Read the metadata of a saved hit object, returning the metadata and the
+    class to load it as
+    """
+    with open(os.path.join(path, "meta.json")) as meta_file:
+        meta = json.load(meta_file)
+    # Find the class the object was saved from
+    hit_class = globals()[meta["class"]]
+    assert issubclass(hit_class, cls),\
+        "ERROR: {} saved as {}, which is not a {}".format(path, meta["class"],
+                                                         cls.__name__)
+    return meta, hit_class
+
+def _narrowest_int_dtype(column):
+    """
+    Returns the narrowest integer dtype that holds every value of the column
+    """
+    if len(column) == 0:
+        return np.dtype(np.uint8)
+    return np.result_type(np.min_scalar_type(column.min()),
+                          np.min_scalar_type(column.max()))
+
+def _check_cast(name, column, dtype):
+    """
+    Checks that the values of the column are unchanged by casting it to dtype
+    """
+    dtype = np.dtype(dtype)
+    if len(column) == 0 or column.dtype == dtype:
+        return
+    if dtype == bool:
+        fits = np.isin(column, [0, 1]).all()
+    elif np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        fits = (column.min() >= info.min) and (column.max() <= info.max)
+    else:
+        finite = column[np.isfinite(column)]
+        fits = (len(finite) == 0) or \
+               (np.abs(finite).max() <= np.finfo(dtype).max)
+    assert fits, "ERROR: values of {} in [{}, {}] overflow {}".format(
+        name, column.min(), column.max(), dtype)
+
+def _ranges_to_indexes(starts, stops):
+    """
+    Returns the indexes in each range [starts[i], stops[i]), one range after
+    the other
+    """
+    n_in_range = stops - starts
+    # Shift a running count of all the indexes so that it starts at the start
+    # of each range
+    shifts = starts - (np.cumsum(n_in_range) - n_in_range)
+    return np.repeat(shifts, n_in_range) + np.arange(n_in_range.sum())
+
+def _segment_searchsorted(values, starts, stops, targets, side="left"):
+    """
+    Returns where each target would be inserted into its segment
+    values[starts[i]:stops[i]], where each segment is sorted, by bisecting
+    all the segments at once
+
+    :param side: "left" for the first place, "right" for the last place
+    """
+    lows = np.array(starts, dtype=np.int64)
+    highs = np.array(stops, dtype=np.int64)
+    targets = np.broadcast_to(targets, lows.shape)
+    active = lows < highs
+    while active.any():
+        mids = (lows + highs) // 2
+        mid_values = values[np.where(active, mids, 0)]
+        if side == "left":
+            go_up = mid_values < targets
+        else:
+            go_up = mid_values <= targets
+        lows = np.where(active & go_up, mids + 1, lows)
+        highs = np.where(active & ~go_up, mids, highs)
+        active = lows < highs
+    return lows
+
+def _get_init_default(cls, name):
+    """
+    Returns the default value of a constructor argument of the class, looking
+    through the base classes for arguments passed on as keywords
+    """
+    for klass in cls.__mro__:
+        params = inspect.signature(klass.__init__).parameters
+        if name in params and \
+                params[name].default is not inspect.Parameter.empty:
+            return params[name].default
+    raise KeyError("{} has no default for {}".format(cls.__name__, name))
+
+class FlatHits(object, metaclass=CachedImport):
     # pylint: disable=too-many-instance-attributes
     # pylint: disable=bad-continuation
+    # Store the data in the narrowest safe dtypes, and the memory this saved
+    compact = False
+    compact_saved_bytes = 0
+    # Number of open batch_trims blocks, which defer re-indexing
+    _batch_depth = 0
+    # Sorted event keys and their event slots, built when first needed
+    _event_key_index = None
+    # Variables the hits of each event are sorted by in ascending order
+    _sorted_by = ()
+    # Columns with bitmap indexes, and the indexes built so far
+    bitmap_names = ()
+    _bitmap_indexes = None
+    # Table of per event aggregates, built when first needed
+    _event_summary = None
+
+    @property
+    def data(self):
+        """
+        HitData of the hits, which reports changes to its columns so that
+        the bitmap indexes built from them are dropped
+        """
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        if isinstance(data, HitData):
+            data.on_change = self._column_changed
+        self._data = data
+
     def __init__(self,
                  path,
                  tree='COMETEventsSummary',
@@ -33,7 +187,15 @@ class FlatHits(object):
                  use_evt_idx=True,
                  signal_coding=1,
                  finalize_data=True,
-                 n_evts=None):
+                 n_evts=None,
+                 single_pass=True,
+                 start=None,
+                 stop=None,
+                 reader=None,
+                 lazy=False,
+                 compact=False,
+                 hit_filters=None,
+                 bitmap_indexes=False):
         """
         Dataset provides an interface to work with MC stored in root format.
         Results of methods are either numpy.arrays or scipy.sparse objects.
@@ -52,6 +214,39 @@ class FlatHits(object):
                            event
         :param signal_coding: value in hit_type_name branch that signifies a
                               signal hit.  Default is 1
+        :param single_pass: import all the needed branches from the root file
+                            in one read.  Set to False to import the branches
+                            one by one to save on memory
+        :param start: first entry of the tree to import
+        :param stop: entry of the tree to stop importing at
+        :param reader: Reader, or name of one, used to import the file.  The
+                       default is root_numpy if it is installed, and uproot
+                       otherwise.  See readers.READERS
+        :param lazy: only import the requested branches when they are first
+                     accessed through data[name], replaying any trims and
+                     sorts done before then
+        :param compact: store the columns in the narrowest safe dtypes, e.g.
+                        32 bit times and charges, unsigned wire IDs, boolean
+                        labels and 32 bit indexes, checking that no values
+                        overflow.  The memory saved, in bytes, is
+                        stored in compact_saved_bytes
+        :param hit_filters: HitPredicate, or list of them, that the kept hits
+                            must pass, e.g.
+                                HitPredicate("EventNumber", values=events)
+                            Each is added to the selection if it can be
+                            written as one on the branches of the file, so
+                            the rejected hits are never imported.  The rest
+                            are applied once the data is imported.
+        :param bitmap_indexes: keep bitmap indexes of categorical columns,
+                               kept through trims and sorts, to select hits
+                               by value without scanning the column.  True
+                               indexes the hit type, and the layer and
+                               hodoscope module where the class has them, or
+                               give a list of the columns to index.  See
+                               add_bitmap_index
+        :param cache: ImportCache, or directory of one, to take the finished
+                      object from if it has already been imported with the
+                      same arguments.  Handled by the CachedImport metaclass
         """
         # Assumptions about data naming and signal labelling conventions
         self.prefix = prefix
@@ -61,6 +256,24 @@ class FlatHits(object):
         self.n_events = n_evts
         self.use_evt_idx = use_evt_idx
         self.selection = selection
+        self.single_pass = single_pass
+        self.compact = compact
+        self.start = start
+        self.stop = stop
+        self.reader = get_reader(reader)
+        # Add the hit filters to the selection where possible, keeping the
+        # rest to apply after the import
+        self._post_filters = self._push_down_filters(path, tree, hit_filters)
+        # Name the columns to keep bitmap indexes of, which are built when
+        # they are first used
+        if bitmap_indexes is True:
+            bitmap_indexes = self._get_bitmap_defaults()
+        self.bitmap_names = [name if name.startswith(self.prefix)
+                             else self.prefix + name
+                             for name in _return_branches_as_list(
+                                 bitmap_indexes or None)]
+        # Raw branches imported in a single pass, consumed as they are used
+        self._branch_cache = dict()
         # Set the number of hits, the number of events, and data to None so that
         # the the next import_root_file knows its the first call
         self.n_hits, self.data = (None, None)
@@ -73,15 +286,26 @@ class FlatHits(object):
                     if not branch.startswith(self.prefix)
                     else branch
                     for branch in branches]
+        # Register the requested branches to be imported when first accessed
+        self.lazy_branches = []
+        if lazy:
+            _ = self._check_for_branches(path, tree, branches)
+            self.lazy_branches, branches = branches, []
         # Ensure hit type is imported in branches
         branches, empty_branches = self._add_name_to_branches(path, tree,
                                                               self.hit_type_name,
                                                               branches,
                                                               empty_branches)
 
+        # Import everything this class will need in one pass of the file
+        if self.single_pass:
+            self._import_all_branches(path, tree,
+                                      branches + [self.key_name] + \
+                                      self._get_import_branches(path, tree))
+
         # Declare out lookup tables
         self.hits_to_events = None
-        self.event_to_hits = None
+        self.event_offsets = None
         self.event_to_n_hits = None
         # Get the number of hits for each event
         self._generate_event_to_n_hits_table(path, tree)
@@ -93,6 +317,9 @@ class FlatHits(object):
         self.n_events = None
         # Fill the counters
         self._generate_counters()
+        # Record the source of the lazy branches
+        self._lazy_source = (path, tree)
+        self._lazy_event_to_n_hits = self.event_to_n_hits.copy()
 
         # Get the hit data we want
         if branches:
@@ -119,6 +346,11 @@ class FlatHits(object):
                                        [self.event_index_name]
         self.data = data_columns + all_key_column + \
                     [hits_index_column] + [event_index_column]
+        # Index each hit by its position in the file for the lazy branches
+        self.source_index_name = self.prefix + "source_index"
+        if self.lazy_branches:
+            self.all_branches += [self.source_index_name]
+            self.data += [np.arange(self.n_hits)]
 
         # Add in the empty branches
         empty_branches = _return_branches_as_list(empty_branches)
@@ -144,12 +376,8 @@ class FlatHits(object):
         :param tree: name of tree in root file
         :param branches: required branches
         """
-        # Import one event with all the branches to get the names of the
-        # branches
-        # TODO use list_branches in root2array here
-        dummy_root = root2array(path, treename=tree, start=0, stop=1)
-        # Get the names of the imported branches
-        availible_branches = dummy_root.dtype.names
+        # Get the names of the branches in this file
+        availible_branches = self.reader.get_branch_names(path, tree)
         # Get the requested branches that are not availible
         bad_branches = list(set(branches) - set(availible_branches))
         bad_request = len(bad_branches) != 0
@@ -182,9 +410,92 @@ class FlatHits(object):
         return branches, empty_branches
 
 
+    def _get_import_branches(self, path, tree):
+        """
+        Returns the branches, beyond the requested ones and the key, that this
+        class imports while it is being constructed
+        """
+        return []
+
+    def _get_hit_filters(self):
+        """
+        Returns the predicates, beyond the requested ones, that every hit of
+        this class must pass
+        """
+        return []
+
+    def _push_down_filters(self, path, tree, hit_filters):
+        """
+        Add the hit filters that can be written as selections on the branches
+        of the file to the selection, and return the others
+
+        :return: list of HitPredicate to apply after the import
+        """
+        availible_branches = self.reader.get_branch_names(path, tree)
+        hit_filters = _return_branches_as_list(hit_filters) + \
+                      self._get_hit_filters()
+        post_filters = []
+        for predicate in hit_filters:
+            # Append the prefix as for the branches
+            predicate = predicate.with_prefix(self.prefix)
+            selection = predicate.to_selection()
+            # Each tree entry is only a hit when the hits are indexed by event,
+            # otherwise the selection would remove whole events
+            can_push = self.use_evt_idx and (selection is not None) and \
+                all(name in availible_branches
+                    for name in get_selection_names(selection))
+            if not can_push:
+                post_filters.append(predicate)
+            elif self.selection is None:
+                self.selection = selection
+            else:
+                self.selection = "({}) && ({})".format(self.selection,
+                                                       selection)
+        return post_filters
+
+    def _import_all_branches(self, path, tree, branches):
+        """
+        Import all the given branches that exist in the file with a single
+        call to the reader.  The result is held until each branch is
+        requested by _import_root_file.
+
+        :param path: path to root file
+        :param tree: name of tree in root file
+        :param branches: branches to import
+        """
+        # Only import the branches that exist, the missing ones will raise the
+        # usual error when they are requested
+        availible_branches = self.reader.get_branch_names(path, tree)
+        branches = [branch for branch in np.unique(branches)
+                    if branch in availible_branches]
+        if not branches:
+            return
+        event_data = self.reader.read(path, tree=tree,
+                                      branches=branches,
+                                      selection=self.selection,
+                                      start=self.start, stop=self.stop)
+        for branch in branches:
+            self._branch_cache[branch] = event_data
+
+    def _read_branch(self, path, tree, branch, keep=False):
+        """
+        Returns the reader output for this branch, using the single pass
+        import if it is availible
+
+        :param keep: keep the single pass import of this branch for later use
+        """
+        if branch in self._branch_cache:
+            if keep:
+                return self._branch_cache[branch]
+            return self._branch_cache.pop(branch)
+        return self.reader.read(path, tree=tree,
+                                branches=[branch],
+                                selection=self.selection,
+                                start=self.start, stop=self.stop)
+
     def _import_root_file(self, path, tree, branches):
         """
-        This wraps root2array to protect the user from importing non-existant
+        This wraps the reader to protect the user from importing non-existant
         branches, which cause the program to hang without any error messages
 
         :param path: path to root file
@@ -199,50 +510,13 @@ class FlatHits(object):
         # Grab the branches one by one to save on memory
         data_columns = []
         for branch in branches:
-            # Count the number of entries to grab
-            #if self.use_evt_idx:
-            #    n_entries = sum(self.event_to_n_hits[:self.n_events])
-            #else:
-            #    n_entries = self.n_events
-            # TODO absorb event loading limit into selection
             # Grab the branch
-            event_data = root2array(path, treename=tree, \
-                                    branches=[branch],
-                                    selection=self.selection)
+            event_data = self._read_branch(path, tree, branch)
             # If we know the number of hits and events, require the branch is as
             # long as one of these
             if (self.n_hits is not None) and (self.n_events is not None):
-                # Record the number of entries
-                data_length = len(event_data)
-                # Deal with variables defined once per event
-                if data_length == self.n_events:
-                    # Concatonate the branch if it is an array of lists, i.e. if
-                    # it is defined for every hit
-                    if event_data.dtype[branch] == object:
-                        event_data = np.concatenate(event_data[branch])
-                        # Check that the right number of hits are defined
-                        data_length = len(event_data)
-                    # Otherwise assume it is defined event-wise, stretch it by
-                    # event so each hit has the value corresponding to its
-                    # event.
-                    else:
-                        # Check the length
-                        data_length = len(event_data)
-                        event_data = event_data[branch][self.hits_to_events]
-                else:
-                    event_data = event_data[branch]
-                # Check that the length of the array makes sense
-                assert (data_length == self.n_hits) or\
-                       (data_length == self.n_events),\
-                       "ERROR: The length of the data in the requested \n"+\
-                       "branch " + branch + " is not the length of the \n"+\
-                       "number of events or the number of hits.\n"+\
-                       "Entries in branch = {}\n".format(data_length)+\
-                       "Hits in sample = {}\n".format(self.n_hits)+\
-                       "Events in sample = {}\n".format(self.n_events)
-
-                # Add this branch
-                data_columns.append(event_data)
+                data_columns.append(self._flatten_branch(event_data, branch,
+                                                         self.event_to_n_hits))
             # If we do not know the number of hits and events, assume its
             # defined hit-wise
             else:
@@ -250,6 +524,109 @@ class FlatHits(object):
         # Return
         return data_columns
 
+    def _flatten_branch(self, event_data, branch, event_to_n_hits):
+        """
+        Returns the imported branch as one value per hit, given the number of
+        hits in each imported event
+        """
+        n_hits = np.sum(event_to_n_hits)
+        n_events = len(event_to_n_hits)
+        # Only keep the entries of the events we kept, i.e. the first
+        # n_evts events
+        if self.use_evt_idx:
+            event_data = event_data[:n_hits]
+        else:
+            event_data = event_data[:n_events]
+        # Record the number of entries
+        data_length = len(event_data)
+        # Deal with variables defined once per event
+        if data_length == n_events:
+            # Concatonate the branch if it is an array of lists, i.e. if
+            # it is defined for every hit
+            if event_data.dtype[branch] == object:
+                event_data = np.concatenate(event_data[branch])
+                # Check that the right number of hits are defined
+                data_length = len(event_data)
+            # Otherwise assume it is defined event-wise, stretch it by
+            # event so each hit has the value corresponding to its
+            # event.
+            else:
+                # Check the length
+                data_length = len(event_data)
+                hits_to_events = np.repeat(np.arange(n_events),
+                                           event_to_n_hits)
+                event_data = event_data[branch][hits_to_events]
+        else:
+            event_data = event_data[branch]
+        # Check that the length of the array makes sense
+        assert (data_length == n_hits) or\
+               (data_length == n_events),\
+               "ERROR: The length of the data in the requested \n"+\
+               "branch " + branch + " is not the length of the \n"+\
+               "number of events or the number of hits.\n"+\
+               "Entries in branch = {}\n".format(data_length)+\
+               "Hits in sample = {}\n".format(n_hits)+\
+               "Events in sample = {}\n".format(n_events)
+        return event_data
+
+    def _load_lazy_column(self, name, rows):
+        """
+        Imports a lazy branch the first time it is accessed and adds it to the
+        data, replaying the trims and sorts done since construction.  Only the
+        entries of the current hits are kept.  Returns the column for the
+        given rows of the data.
+        """
+        if name not in self.data:
+            # Import the branch as it was ordered at construction
+            path, tree = self._lazy_source
+            event_data = self._read_branch(path, tree, name)
+            column = self._flatten_branch(event_data, name,
+                                          self._lazy_event_to_n_hits)
+            # Add it to the data, so that changes to it are kept
+            self.data.add_column(name,
+                                 column[self.data[self.source_index_name]])
+            self.all_branches.append(name)
+            if rows is not self.data:
+                return column[rows[self.source_index_name]]
+        if rows is self.data:
+            return self.data[name]
+        # Find the given rows in the current data by their source index
+        source_index = self.data[self.source_index_name]
+        source_order = np.argsort(source_index)
+        places = np.searchsorted(source_index, rows[self.source_index_name],
+                                 sorter=source_order)
+        places = source_order[np.minimum(places, len(source_order) - 1)]
+        assert np.array_equal(source_index[places],
+                              rows[self.source_index_name]),\
+            "ERROR: lazy branch {} requested for hits that were ".format(name)+\
+            "removed from the data"
+        return self.data[name][places]
+
+    def _set_lazy_data(self):
+        """
+        Let the data import the lazy branches when they are accessed
+        """
+        self.data.lazy_names = tuple(self.lazy_branches)
+        self.data.loader = self._load_lazy_column
+
+    def load_lazy_branches(self):
+        """
+        Import all the lazy branches that have not been accessed yet.  The
+        source index column is then removed, as it is only needed to import
+        them, so the data has the same columns as that of a hit object built
+        without lazy branches.
+        """
+        if not self.lazy_branches:
+            return
+        for name in self.lazy_branches:
+            _ = self.data[name]
+        self.lazy_branches = []
+        self.data.lazy_names = ()
+        self.data.loader = None
+        self.data.remove_columns([self.source_index_name])
+        self.all_branches = [name for name in self.all_branches
+                             if name != self.source_index_name]
+
     def _generate_event_to_n_hits_table(self, path, tree):
         """
         Creates look up tables to map from event index to number of hits from
@@ -257,10 +634,8 @@ class FlatHits(object):
         """
         # Check the branch we need to define the number of hits is there
         _ = self._check_for_branches(path, tree, branches=[self.key_name])
-        # Import the data
-        event_data = root2array(path, treename=tree,
-                                branches=[self.key_name],
-                                selection=self.selection)
+        # Import the data, keeping it to fill the key column later
+        event_data = self._read_branch(path, tree, self.key_name, keep=True)
         event_data = event_data[self.key_name]
         # Return the number of hits in each event
         if self.use_evt_idx:
@@ -279,26 +654,65 @@ class FlatHits(object):
         """
         Generate mappings between hits and events from current event_to_n_hits
         """
-        # Build the look up tables
-        first_hit = 0
-        try:
-            hits_to_events = np.zeros(sum(self.event_to_n_hits))
-        except ValueError:
-            print(type(self.event_to_n_hits))
-        event_to_hits = []
-        for event, n_hits in enumerate(self.event_to_n_hits):
-            # Record the last hit in the event
-            last_hit = first_hit + n_hits
-            # Record the range of hit IDs
-            event_to_hits.append(np.arange(first_hit, last_hit))
-            # Record the event of each hit
-            hits_to_events[first_hit:last_hit] = event
-            # Shift to the next event
-            first_hit = last_hit
-        # Shift the event-to-hit list into a numpy object array
-        self.event_to_hits = np.array(event_to_hits)
-        # Ensure all indexes in hits to events are integers
-        self.hits_to_events = hits_to_events.astype(int)
+        index_dtype = self._get_index_dtype()
+        # The hits of event i are stored in the range
+        # [event_offsets[i], event_offsets[i+1])
+        self.event_offsets = np.zeros(len(self.event_to_n_hits) + 1,
+                                      dtype=index_dtype)
+        np.cumsum(self.event_to_n_hits, out=self.event_offsets[1:])
+        # Record the event of each hit
+        self.hits_to_events = np.repeat(np.arange(len(self.event_to_n_hits),
+                                                  dtype=index_dtype),
+                                        self.event_to_n_hits)
+
+    def _get_index_dtype(self):
+        """
+        Returns the dtype of the event offsets and the hit and event indexes
+        """
+        if not self.compact:
+            return np.int64
+        assert np.sum(self.event_to_n_hits) <= np.iinfo(np.int32).max,\
+            "ERROR: too many hits for the compact 32 bit indexes"
+        return np.int32
+
+    def _get_compact_dtypes(self):
+        """
+        Returns the dtype of each column in compact mode
+        """
+        dtypes = {self.hits_index_name : np.int32,
+                  self.event_index_name : np.int32,
+                  self.source_index_name : np.int32}
+        # Store the hit labels as booleans if they are only zero and one
+        hit_types = self.data[self.hit_type_name]
+        if self.signal_coding in (0, 1) and np.isin(hit_types, [0, 1]).all():
+            dtypes[self.hit_type_name] = bool
+        return dtypes
+
+    def _compact_data(self):
+        """
+        Convert the data to the narrowest safe dtypes, checking that no values
+        overflow, and record the memory saved in compact_saved_bytes
+        """
+        # The lookup tables and index columns may already be built compact,
+        # so count them at the 64 bit width they would otherwise have
+        index_names = [name for name in [self.hits_index_name,
+                                         self.event_index_name,
+                                         self.source_index_name]
+                       if name in self.data]
+        n_index_entries = len(self.hits_to_events) + \
+                          len(self.event_offsets) + \
+                          len(index_names) * len(self.data)
+        old_bytes = sum(self.data[name].nbytes for name in self.data.names
+                        if name not in index_names) + \
+                    n_index_entries * np.dtype(np.int64).itemsize
+        dtypes = self._get_compact_dtypes()
+        for name, dtype in dtypes.items():
+            if name in self.data:
+                _check_cast(name, self.data[name], dtype)
+        self.data.cast_columns(dtypes)
+        new_bytes = self.data.nbytes + self.hits_to_events.nbytes + \
+                    self.event_offsets.nbytes
+        self.compact_saved_bytes = old_bytes - new_bytes
 
     def _generate_counters(self):
         """
@@ -314,6 +728,21 @@ class FlatHits(object):
         self.data[self.hits_index_name] = np.arange(self.n_hits)
         self.data[self.event_index_name] = self.hits_to_events
 
+    def _generate_event_keys(self):
+        """
+        Record the key of each event from its first hit.  The event keys are
+        then kept through trims and merges, so hits added from other events
+        do not change the key of the event they join.
+        """
+        self.event_keys = self.data[self.key_name][self.event_offsets[:-1]]
+
+    def _get_hit_events(self):
+        """
+        Returns the event of each hit, from the number of hits in each event,
+        which is kept up to date inside batch_trims
+        """
+        return np.repeat(np.arange(self.n_events), self.event_to_n_hits)
+
     def _reset_all_internal_data(self):
         """
         Reset all look up tables, indexes, and counts
@@ -325,57 +754,213 @@ class FlatHits(object):
         # Set the indexes
         self._generate_indexes()
 
-    def _reset_event_to_n_hits(self):
-        # Find the hits to remove
-        self.event_to_n_hits = np.bincount(self.data[self.event_index_name],
-                                           minlength=self.n_events)
-        # Remove these sums
-        assert (self.event_to_n_hits >= 0).all(),\
-                "Negative number of hits not allowed!"
-        # Trim the look up tables of empty events
-        empty_events = np.where(self.event_to_n_hits > 0)[0]
-        self._trim_lookup_tables(empty_events)
+    def _keep_hits(self, mask):
+        """
+        Keep the hits in the boolean mask.  The number of hits kept in each
+        event is read from a running count of the mask at the event offsets,
+        so the lookup tables are updated without recounting the hits of each
+        event.  Inside batch_trims, the hit and event indexes are only reset
+        at the end of the batch.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        # Count the hits kept before each hit, so the hits kept in event i are
+        # n_kept[event_offsets[i+1]] - n_kept[event_offsets[i]]
+        n_kept = np.zeros(len(mask) + 1, dtype=self.event_offsets.dtype)
+        np.cumsum(mask, out=n_kept[1:])
+        n_kept = n_kept[self.event_offsets]
+        evt_n_hits = n_kept[1:] - n_kept[:-1]
+        # Remove the hits and the events left empty
+        self.data = self.data[mask]
+        self._take_bitmap_indexes(mask)
+        kept_events = evt_n_hits > 0
+        self._trim_event_summary(kept_events, evt_n_hits)
+        self.event_to_n_hits = evt_n_hits[kept_events]
+        self.event_keys = self.event_keys[kept_events]
+        self._trim_event_key_index(kept_events)
+        # Only the offsets are needed to find the hits of each event while
+        # the re-indexing is deferred
+        if self._batch_depth:
+            self.event_offsets = np.zeros(len(self.event_to_n_hits) + 1,
+                                          dtype=self.event_offsets.dtype)
+            np.cumsum(self.event_to_n_hits, out=self.event_offsets[1:])
+            self.n_hits = len(self.data)
+            self.n_events = len(self.event_to_n_hits)
+        else:
+            self._reset_all_internal_data()
 
-    def _trim_lookup_tables(self, events):
+    def invalidate_event_summary(self):
         """
-        Trim the lookup tables to the given event indexes
+        Drop the table of per event aggregates, see
+        GeomHits.get_event_summary, so that it is recomputed from the hits when
+        next needed.  Call this after changing the hits in place.
         """
-        # Trim the event indexed tables
-        self.event_to_n_hits = self.event_to_n_hits[events]
-        # Set the lookup tables
-        self._reset_all_internal_data()
+        self._event_summary = None
+
+    def _trim_event_summary(self, kept_events, evt_n_hits):
+        """
+        Keep the rows of the event summary of the kept events if every kept
+        event keeps all of its hits.  Otherwise the summary is not updated
+        row by row, but dropped to be recomputed when next needed
+
+        :param kept_events: boolean mask of the events kept
+        :param evt_n_hits: number of hits kept in each event
+        """
+        if self._event_summary is None:
+            return
+        if np.array_equal(evt_n_hits[kept_events],
+                          self.event_to_n_hits[kept_events]):
+            self._event_summary = self._event_summary[kept_events]
+        else:
+            self.invalidate_event_summary()
+
+    @contextmanager
+    def batch_trims(self):
+        """
+        Defer resetting the hit and event indexes until the end of a batch of
+        trims, e.g.
+
+            with hits.batch_trims():
+                hits.trim_hits(hits.time_name, less_than=1620)
+                hits.trim_events(good_events)
+
+        Inside the batch, the hits of each event can still be found by event,
+        and the hits can be sorted, but the hits_index and event_index
+        columns, and hits_to_events, are out of date until the batch ends.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self._reset_all_internal_data()
 
     def _finalize_data(self):
         """
-        Zip up the data into a rec array if this is the highest level class of
-        this instance
+        Zip up the data into a HitData container if this is the highest level
+        class of this instance
         """
-        self.data = np.rec.fromarrays(self.data, names=(self.all_branches))
+        self.data = HitData(self.data, names=self.all_branches)
         self._generate_indexes()
+        self._generate_event_keys()
+        # Apply the hit filters that could not be applied by the reader
+        if self._post_filters:
+            HitQuery(self, self._post_filters).trim()
+            self._post_filters = []
+        if self.compact:
+            self._compact_data()
+        # Release anything left over from the single pass import
+        self._branch_cache.clear()
+        if self.lazy_branches:
+            self._set_lazy_data()
 
     def _get_mask(self, these_hits, variable, values=None, greater_than=None,
                   less_than=None, invert=False):
         """
-        Returns the section of the data where the variable equals
+        Returns the boolean mask of the hits where the variable equals
         any of the values
         """
-        # Default is all true
-        mask = np.ones(len(these_hits))
-        if not values is None:
-            # Switch to a list if a single value is given
-            if not isinstance(values, list):
-                values = [values]
-            this_mask = np.in1d(these_hits[variable], values)
-            mask = np.logical_and(mask, this_mask)
-        if not greater_than is None:
-            this_mask = these_hits[variable] > greater_than
-            mask = np.logical_and(mask, this_mask)
-        if not less_than is None:
-            this_mask = these_hits[variable] < less_than
-            mask = np.logical_and(mask, this_mask)
-        if invert:
-            mask = np.logical_not(mask)
-        return mask
+        predicate = HitPredicate(variable, values=values,
+                                 greater_than=greater_than,
+                                 less_than=less_than, invert=invert)
+        return predicate.evaluate(these_hits)
+
+    def query(self):
+        """
+        Returns a HitQuery to chain selections of the hits with, which are
+        evaluated together as one mask
+        """
+        return HitQuery(self)
+
+    def get_hit_indexes(self, events):
+        """
+        Returns the flat hit indexes of the given event(s), in the order the
+        events are given.  Events may be repeated.
+
+        :return: numpy.array of hit indexes
+        """
+        # Allow for a single event
+        if isinstance(events, (int, np.integer)):
+            if events < 0:
+                events += self.n_events
+            return np.arange(self.event_offsets[events],
+                             self.event_offsets[events + 1])
+        events = np.asarray(events, dtype=np.int64).ravel()
+        events = np.where(events < 0, events + self.n_events, events)
+        # Get the range of hits in each event
+        return _ranges_to_indexes(self.event_offsets[events],
+                                  self.event_offsets[events + 1])
+
+    @property
+    def event_to_hits(self):
+        """
+        Deprecated, use get_hit_indexes or event_offsets instead.  Returns the
+        hit indexes of each event as an object array of arrays, built from the
+        event offsets each time it is accessed.
+        """
+        warnings.warn("event_to_hits is deprecated, use get_hit_indexes or "
+                      "event_offsets instead", DeprecationWarning,
+                      stacklevel=2)
+        event_to_hits = np.empty(self.n_events, dtype=object)
+        for event in range(self.n_events):
+            event_to_hits[event] = np.arange(self.event_offsets[event],
+                                             self.event_offsets[event + 1])
+        return event_to_hits
+
+    def event_view(self, event):
+        """
+        Returns the hits of one event as a view of the data, without copying.
+        Changes to the view change the data.
+        """
+        if event < 0:
+            event += self.n_events
+        return self.data[self.event_offsets[event]:
+                         self.event_offsets[event + 1]]
+
+    def iter_events(self, events=None):
+        """
+        Iterate over the hits of each event as views of the data, see
+        event_view.  Default is all events in order.
+        """
+        if events is None:
+            events = range(self.n_events)
+        for event in events:
+            yield self.event_view(event)
+
+    def __len__(self):
+        """
+        Returns the number of events, as for n_events
+        """
+        return self.n_events
+
+    def __bool__(self):
+        """
+        Hit objects are always true, even with no events, so that defining
+        __len__ does not change the meaning of "if hits:".  Test n_events to
+        check for events.
+        """
+        return True
+
+    def __getitem__(self, key):
+        """
+        Returns the hits of events as a sequence of events:
+         - hits[event] is a view of the hits of one event
+         - hits[start:stop] is a view of the hits of a range of events
+         - hits[events] for a list or array of events copies their hits
+         - hits[name] is the column of all the hits
+        """
+        if isinstance(key, str):
+            return self.data[key]
+        if isinstance(key, (int, np.integer)):
+            return self.event_view(key)
+        if isinstance(key, slice):
+            events = range(self.n_events)[key]
+            # Consecutive events are one slice of the data
+            if events.step == 1:
+                return self.data[self.event_offsets[events.start]:
+                                 self.event_offsets[events.stop]]
+            key = np.array(events)
+        return self.data[self.get_hit_indexes(key)]
 
     def get_events(self, events=None, unique=True):
         """
@@ -386,46 +971,127 @@ class FlatHits(object):
         # Check if we want all events
         if events is None:
             return self.data
-        # Allow for a single event
-        if isinstance(events, int):
-            evt_hits = self.event_to_hits[events]
-        # Otherwise assume it is a list of events.
-        else:
-            # Ensure we only get each event once
-            # TODO remove and check that this is fine.  Sorts the event ids 
-            # before returning them.  This is bad
-            if unique:
-                events = np.unique(events)
-            # Get all the hits we want as flat
-            evt_hits = np.concatenate([self.event_to_hits[evt]\
-                                       for evt in events])
+        # Ensure we only get each event once from a list of events
+        # TODO remove and check that this is fine.  Sorts the event ids
+        # before returning them.  This is bad
+        if unique and not isinstance(events, (int, np.integer)):
+            events = np.unique(events)
         # Return the data for these events
-        return self.data[evt_hits]
+        return self.data[self.get_hit_indexes(events)]
+
+    def _get_event_key_index(self):
+        """
+        Returns the event keys in sorted order and the event slot of each,
+        building the index the first time it is needed
+        """
+        if self._event_key_index is None:
+            event_keys = self.get_event_keys()
+            event_slots = np.argsort(event_keys, kind="stable")
+            self._event_key_index = (event_keys[event_slots], event_slots)
+        return self._event_key_index
+
+    def _trim_event_key_index(self, kept_events):
+        """
+        Keep the entries of the event key index for the kept events, mapping
+        them onto the new event slots
+
+        :param kept_events: boolean mask over the current event slots
+        """
+        if self._event_key_index is None:
+            return
+        sorted_keys, event_slots = self._event_key_index
+        is_kept = kept_events[event_slots]
+        new_slots = np.cumsum(kept_events) - 1
+        self._event_key_index = (sorted_keys[is_kept],
+                                 new_slots[event_slots[is_kept]])
+
+    def get_event_keys(self):
+        """
+        Returns the key, i.e. the event number, of each event.  This is the
+        key of the first hit of the event when the data was imported, and is
+        not changed by adding hits with other keys, see add_hits.
+
+        :return: numpy.array of shape [self.n_events]
+        """
+        return self.event_keys
+
+    def get_event_slots(self, keys, all_events=False):
+        """
+        Returns the event index of each of the given keys, i.e. event numbers,
+        in the order they are given, or -1 for keys that are not in the data.
+        Uses a sorted index of the keys kept through trims.
+
+        Several events share a key when samples are combined without
+        rebasing their keys, see concatenate_hits.  By default, the first of
+        these events is returned for each key.
+
+        :param all_events: return the index of every event with each key
+                           instead, one key after the other, leaving out the
+                           keys that are not in the data
+        :return: numpy.array of event indexes
+        """
+        sorted_keys, event_slots = self._get_event_key_index()
+        keys = np.atleast_1d(keys)
+        # Find the range of the sorted keys equal to each key
+        starts = np.searchsorted(sorted_keys, keys, side="left")
+        stops = np.searchsorted(sorted_keys, keys, side="right")
+        if all_events:
+            return event_slots[_ranges_to_indexes(starts, stops)]
+        if len(sorted_keys) == 0:
+            return np.full(len(keys), -1, dtype=int)
+        return np.where(stops > starts,
+                        event_slots[np.minimum(starts, len(event_slots) - 1)],
+                        -1)
 
     def trim_events(self, events):
         """
-        Keep these events in the data
+        Keep these events in the data, given by key, i.e. event number.  All
+        the events with each key are kept.
         """
-        self.trim_hits(self.key_name, values=events)
+        # Find the events through the key index instead of testing every hit
+        kept_events = np.zeros(self.n_events, dtype=bool)
+        kept_events[self.get_event_slots(events, all_events=True)] = True
+        self._keep_hits(np.repeat(kept_events, self.event_to_n_hits))
 
     def sort_hits(self, variable, ascending=True, reset_index=True):
         """
         Sorts the hits by the given variable inside each event.  By default,
         this is done in acending order and the hit index is reset after sorting.
-        """
-        # Sort each event internally
-        for evt in range(self.n_events):
-            # Get the hits to sort
-            evt_hits = self.event_to_hits[evt]
-            # Get the sort order of the given variable
-            sort_order = self.data[evt_hits].argsort(order=variable)
-            # Reverse the order if required
-            if not ascending:
-                sort_order = sort_order[::-1]
-            # Rearrange the hits
-            self.data[evt_hits] = self.data[evt_hits][sort_order]
-        # Reset the hit index
-        if reset_index:
+        A list of variables sorts by each in turn.  As when sorting a record
+        array, ties are broken by the remaining columns in the order they are
+        stored.
+        """
+        # Allow for a single variable
+        if not isinstance(variable, list):
+            variable = [variable]
+        # Break ties with the remaining columns before the hit index, then
+        # with the position of each hit, which is the hit index outside of
+        # batch_trims
+        all_names = list(self.data.names)
+        if self.hits_index_name in all_names:
+            all_names = all_names[:all_names.index(self.hits_index_name)]
+        tie_names = [name for name in all_names if name not in variable]
+        # Sort by event first, noting lexsort uses the last key as the primary
+        # key.  The event of each hit is taken from the event offsets, since
+        # the event index column is out of date inside batch_trims
+        hit_events = self._get_hit_events()
+        sort_order = np.lexsort([np.arange(len(self.data))] +
+                                [self.data[name]
+                                 for name in (variable + tie_names)[::-1]] +
+                                [hit_events])
+        # Reverse the order within each event if required
+        if not ascending:
+            evt_idx = hit_events[sort_order]
+            reverse = self.event_offsets[:-1][evt_idx] + \
+                      self.event_offsets[1:][evt_idx] - 1 - \
+                      np.arange(len(sort_order))
+            sort_order = sort_order[reverse]
+        # Rearrange the hits
+        self.data = self.data[sort_order]
+        self._take_bitmap_indexes(sort_order)
+        self._sorted_by = list(variable) if ascending else []
+        # Reset the hit index, which waits for the end of a batch of trims
+        if reset_index and not self._batch_depth:
             self._generate_indexes()
 
     def filter_hits(self, variable, these_hits=None,
@@ -452,19 +1118,120 @@ class FlatHits(object):
                               values=values, greater_than=greater_than,
                               less_than=less_than, invert=invert)
         # Remove the hits
-        self.data = self.data[mask]
-        self._reset_event_to_n_hits()
+        self._keep_hits(mask)
+
+    def add_hits(self, hits, event_indexes=None, merge_on=None,
+                 use_host_keys=False):
+        """
+        Add the hits to the events of the current data.  The hits of event i
+        of the given hits are added to event event_indexes[i] if event indexes
+        are supplied.  Otherwise, they are stacked on top of each event,
+        starting with event 0.
+
+        The identity of each event is defined by this data and not by its
+        hits: the event keys, see get_event_keys, are not changed by the
+        added hits, so trim_events, keep_common_events and the cuts that
+        return event keys follow the events of this data.  The added hits keep
+        their own value of the key column unless use_host_keys is set, in
+        which case they are labelled with the key of the event they join.
+        Set it when selecting hits by their key column afterwards, e.g. with
+        HitQuery.events, so that the added hits go with their event.
+
+        The added hits are merged into each event in order of merge_on, which
+        defaults to the variable the data is sorted by, e.g. the hit time, so
+        the existing hits are never re-sorted.  If the data is not sorted,
+        the added hits go to the end of each event.
+
+        :param hits: hit data, or a hit object, with the columns of this data
+        :param event_indexes: event of this data to add each event of the
+                              given hits to
+        :param merge_on: variable the hits of each event are sorted by
+        :param use_host_keys: give the added hits the key of the event they
+                              are added to
+        """
+        if isinstance(hits, FlatHits):
+            hits.load_lazy_branches()
+            hits = hits.data
+        self.load_lazy_branches()
+        # Lazy columns of the added hits are imported when they are read
+        missing = [name for name in self.data.names
+                   if name not in hits and name not in hits.lazy_names]
+        if missing:
+            raise ValueError("ERROR: the added hits are missing the "
+                             "columns {}".format(missing))
+        # Find the event each hit is added to
+        dest_events = np.asarray(hits[self.event_index_name], dtype=np.int64)
+        if event_indexes is not None:
+            dest_events = np.asarray(event_indexes, dtype=np.int64)[dest_events]
+        assert ((dest_events >= 0) & (dest_events < self.n_events)).all(),\
+            "ERROR: hits added to events outside of the {} events".format(
+                self.n_events)
+        if merge_on is None and self._sorted_by:
+            merge_on = self._sorted_by[0]
+        # Order the added hits by the event they go to, then by merge_on, which
+        # only sorts the added hits
+        if merge_on is None:
+            add_order = np.argsort(dest_events, kind="stable")
+        else:
+            add_order = np.lexsort((hits[merge_on], dest_events))
+        dest_events = dest_events[add_order]
+        hits = hits[add_order]
+        # Find where each added hit goes in its event, after any existing hits
+        # with the same value
+        if merge_on is None:
+            places = self.event_offsets[dest_events + 1]
+        else:
+            places = _segment_searchsorted(self.data[merge_on],
+                                           self.event_offsets[dest_events],
+                                           self.event_offsets[dest_events + 1],
+                                           hits[merge_on], side="right")
+        # Shift each hit along by the number of hits placed before it
+        n_old, n_new = self.n_hits, len(hits)
+        new_places = places + np.arange(n_new)
+        old_places = np.arange(n_old) + \
+                     np.searchsorted(places, np.arange(n_old), side="right")
+        # Merge the columns
+        columns = dict()
+        for name in self.data.names:
+            columns[name] = np.empty(n_old + n_new,
+                                     dtype=np.result_type(self.data[name],
+                                                          hits[name]))
+            columns[name][old_places] = self.data[name]
+            columns[name][new_places] = hits[name]
+        # Label the added hits with the key of their event if asked
+        if use_host_keys:
+            columns[self.key_name][new_places] = \
+                self.get_event_keys()[dest_events]
+        self.data = HitData(columns)
+        # The order of the hits is only kept for merge_on
+        if list(self._sorted_by[:1]) != [merge_on]:
+            self._sorted_by = []
+        self._sorted_by = list(self._sorted_by[:1])
+        self._bitmap_indexes = None
+        self.invalidate_event_summary()
+        # Count the added hits in each event
+        self.event_to_n_hits = self.event_to_n_hits + \
+            np.bincount(dest_events, minlength=self.n_events)
+        self._reset_all_internal_data()
 
-    def add_hits(self, hits, event_indexes=None):
+    def add_events(self, keys):
         """
-        Append the hits to the current data. If event indexes are supplied, then
-        the hits are added event-wise to the event indexes provided.  Otherwise,
-        they are stacked on top of each event, starting with event 0
+        Append events with no hits and the given keys after the current
+        events, e.g. to give add_hits events to add hits to.  Events that are
+        still empty are removed by the next trim.
+
+        :param keys: key, i.e. event number, of each new event
         """
-        # TODO fix the fact that flathits will break cause no time_name
-        self.data = np.hstack([self.data, hits])
-        self.data.sort(order=[self.event_index_name, self.time_name])
-        self._reset_event_to_n_hits()
+        keys = np.atleast_1d(keys)
+        self.event_to_n_hits = np.append(
+            self.event_to_n_hits,
+            np.zeros(len(keys), dtype=self.event_to_n_hits.dtype))
+        self.event_keys = np.append(self.event_keys, keys)
+        self._event_key_index = None
+        self.invalidate_event_summary()
+        # The existing hits keep their hit and event indexes
+        self._generate_lookup_tables()
+        self._generate_counters()
 
     def remove_branch(self, branch_names):
         """
@@ -472,14 +1239,13 @@ class FlatHits(object):
         """
         if not isinstance(branch_names, list):
             branch_names = [branch_names]
-        all_names = list(self.data.dtype.names)
         for branch in branch_names:
-            prefixed_branch = self.prefix + branch
-            if branch in all_names:
-                all_names.remove(branch)
-            elif prefixed_branch in all_names:
-                all_names.remove(prefixed_branch)
-        self.data = self.data[all_names]
+            if branch not in self.data:
+                branch = self.prefix + branch
+            # Drop the column without copying the others
+            self.data.remove_columns(branch)
+            if branch in self.all_branches:
+                self.all_branches.remove(branch)
 
     def get_other_hits(self, hits):
         """
@@ -489,11 +1255,99 @@ class FlatHits(object):
         events = np.unique(events)
         return self.get_events(events)
 
+    def _get_bitmap_defaults(self):
+        """
+        Returns the columns indexed when bitmap_indexes is True
+        """
+        return [self.hit_type_name]
+
+    def _get_bitmap_column(self, name):
+        """
+        Returns the values of an indexed column, which subclasses may derive
+        from the data
+        """
+        return self.data[name]
+
+    def _get_bitmap_sources(self, name):
+        """
+        Returns the columns the values of an indexed column are taken from
+        """
+        return [name]
+
+    def _column_changed(self, name):
+        """
+        Drop the bitmap indexes built from a column of the data once it is
+        assigned, added or removed
+        """
+        if not self._bitmap_indexes:
+            return
+        for index_name in list(self._bitmap_indexes):
+            if name in self._get_bitmap_sources(index_name):
+                del self._bitmap_indexes[index_name]
+
+    def _get_bitmap_index(self, name):
+        """
+        Returns the bitmap index of the column, building it if needed, or
+        None if the column is not indexed
+        """
+        if name not in self.bitmap_names:
+            return None
+        if self._bitmap_indexes is None:
+            self._bitmap_indexes = dict()
+        if name not in self._bitmap_indexes:
+            self._bitmap_indexes[name] = \
+                BitmapIndex(self._get_bitmap_column(name))
+        return self._bitmap_indexes[name]
+
+    def _take_bitmap_indexes(self, hits):
+        """
+        Keep the bitmap indexes of the selected hits, in the order selected
+        """
+        if not self._bitmap_indexes:
+            return
+        for name, index in self._bitmap_indexes.items():
+            self._bitmap_indexes[name] = index.take(hits)
+
+    def add_bitmap_index(self, name):
+        """
+        Keep a bitmap index of a categorical column, e.g. one declared by the
+        user, which is kept through trims and sorts, and rebuilt when next
+        needed once the column is assigned through the data.  The column may
+        take at most hit_data.MAX_BITMAP_VALUES distinct values.
+
+        :return: BitmapIndex of the column
+        """
+        if name not in self.bitmap_names:
+            self.bitmap_names = list(self.bitmap_names) + [name]
+        return self._get_bitmap_index(name)
+
+    def _get_indexed_hits(self, name, values, events=None, invert=False):
+        """
+        Returns the hits from the given event(s) where the indexed column
+        takes any of the values, read from its bitmap index.  Returns None if
+        the column has no bitmap index.
+        """
+        index = self._get_bitmap_index(name)
+        if index is None:
+            return None
+        if events is None:
+            return self.data[index.get_mask(values, invert=invert)]
+        # Only read the bits of the hits in these events
+        if not isinstance(events, (int, np.integer)):
+            events = np.unique(events)
+        hit_indexes = self.get_hit_indexes(events)
+        mask = index.get_mask(values, hit_indexes=hit_indexes, invert=invert)
+        return self.data[hit_indexes[mask]]
+
     def get_signal_hits(self, events=None):
         """
         Returns the hits from the same event(s) as the given hit list.
         Default gets hits from all events.
         """
+        these_hits = self._get_indexed_hits(self.hit_type_name,
+                                            self.signal_coding, events)
+        if these_hits is not None:
+            return these_hits
         # Get the events
         these_hits = self.filter_hits(self.hit_type_name,
                                       these_hits=self.get_events(events),
@@ -505,12 +1359,69 @@ class FlatHits(object):
         Returns the hits from the same event(s) as the given hit list
         Default gets hits from all events.
         """
+        these_hits = self._get_indexed_hits(self.hit_type_name,
+                                            self.signal_coding, events,
+                                            invert=True)
+        if these_hits is not None:
+            return these_hits
         these_hits = self.filter_hits(self.hit_type_name,
                                       these_hits=self.get_events(events),
                                       values=self.signal_coding,
                                       invert=True)
         return these_hits
 
+    @classmethod
+    def get_chunk_ranges(cls, path, events_per_chunk=10000,
+                         tree='COMETEventsSummary', **kwargs):
+        """
+        Returns the (start, stop) tree entries of consecutive ranges of
+        events_per_chunk events.  Only the key branch is imported.  The other
+        arguments are those of the constructor, and are used to find the key
+        branch as the constructor would.
+
+        :return: list of (start, stop) entry pairs
+        """
+        # Get the name of the key branch as the constructor would
+        prefix = kwargs.get("prefix", _get_init_default(cls, "prefix"))
+        key_name = prefix + kwargs.get("key_name",
+                                       _get_init_default(cls, "key_name"))
+        use_evt_idx = kwargs.get("use_evt_idx",
+                                 _get_init_default(cls, "use_evt_idx"))
+        # Find the first entry of each event, ignoring the selection so that
+        # the entries line up with the tree
+        reader = get_reader(kwargs.get("reader", None))
+        event_keys = reader.read(path, tree=tree,
+                                 branches=[key_name])[key_name]
+        n_entries = len(event_keys)
+        if use_evt_idx:
+            first_entries = np.flatnonzero(np.diff(event_keys)) + 1
+            first_entries = np.append(0, first_entries)
+        # Otherwise each entry is an event
+        else:
+            first_entries = np.arange(n_entries)
+        # Group the events into chunks
+        chunk_starts = first_entries[::events_per_chunk]
+        chunk_stops = np.append(chunk_starts[1:], n_entries)
+        return [(int(start), int(stop))
+                for start, stop in zip(chunk_starts, chunk_stops)]
+
+    @classmethod
+    def iter_chunks(cls, path, events_per_chunk=10000,
+                    tree='COMETEventsSummary', **kwargs):
+        """
+        Iterate over the file in ranges of consecutive events, yielding a hit
+        object built from only the tree entries of each range.  Only the key
+        branch is imported for the whole file, so memory is bounded by the
+        chunk size.  All other arguments are passed to the constructor.
+
+        :param path: path to rootfile
+        :param events_per_chunk: number of events in each hit object
+        :param tree: name of the tree in root dataset
+        """
+        for start, stop in cls.get_chunk_ranges(path, events_per_chunk,
+                                                tree=tree, **kwargs):
+            yield cls(path, tree=tree, start=start, stop=stop, **kwargs)
+
     def print_branches(self):
         """
         Print the names of the data available once you are done
@@ -518,11 +1429,137 @@ class FlatHits(object):
         # Print status message
         print("Branches available are:")
         print("\n".join(self.all_branches))
+        if self.lazy_branches:
+            print("Lazy branches, imported when first used, are:")
+            print("\n".join(self.lazy_branches))
+
+    def save(self, path):
+        """
+        Save the hits to the directory path.  Each column and the event offsets
+        are written as uncompressed .npy files, alongside a meta.json file
+        holding the naming conventions, signal coding and geometry type.
+
+        :param path: directory to save into, created if needed
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.load_lazy_branches()
+        names = list(self.data.names)
+        # Number the column files to avoid odd characters in branch names
+        for col, name in enumerate(names):
+            np.save(os.path.join(path, "column_{}.npy".format(col)),
+                    np.ascontiguousarray(self.data[name]))
+        np.save(os.path.join(path, "event_offsets.npy"), self.event_offsets)
+        np.save(os.path.join(path, "event_keys.npy"), self.event_keys)
+        geom = getattr(self, "geom", None)
+        _write_metadata(path, {"class" : self.__class__.__name__,
+                               "columns" : names,
+                               "geom" : type(geom).__name__ if geom else None,
+                               "reader" : self.reader.name,
+                               "attributes" : _json_attributes(self)})
+
+    @classmethod
+    def load(cls, path, mmap=False):
+        """
+        Load hits saved by save(path), returning an object of the saved class
+
+        :param path: directory the hits were saved to
+        :param mmap: memory-map the saved columns instead of reading them.
+                     Changes to the data are kept in memory only
+        """
+        meta, hit_class = _read_metadata(path, cls)
+        hits = hit_class.__new__(hit_class)
+        hits.__dict__.update(meta["attributes"])
+        if meta["geom"] is not None:
+            hits.geom = GEOMETRIES[meta["geom"]]()
+        # Restore the state of the import, which is finished, so that there
+        # are no filters or lazy branches left to apply
+        hits.reader = get_reader(meta.get("reader", None))
+        hits._post_filters = []
+        hits._branch_cache = dict()
+        hits.lazy_branches = []
+        # Map the columns copy-on-write so the data can still be modified.
+        # The mapped columns are used as they are, without copying
+        mmap_mode = "c" if mmap else None
+        columns = [np.load(os.path.join(path, "column_{}.npy".format(col)),
+                           mmap_mode=mmap_mode)
+                   for col in range(len(meta["columns"]))]
+        hits.data = HitData(columns, names=meta["columns"])
+        # Rebuild the look up tables from the event offsets
+        event_offsets = np.load(os.path.join(path, "event_offsets.npy"))
+        hits.event_to_n_hits = np.diff(event_offsets)
+        hits._generate_lookup_tables()
+        hits._generate_counters()
+        # Older saves have no event keys, so take them from the first hits
+        keys_path = os.path.join(path, "event_keys.npy")
+        if os.path.exists(keys_path):
+            hits.event_keys = np.load(keys_path)
+        else:
+            hits._generate_event_keys()
+        return hits
+
+def _copy_hits(hits):
+    """
+    Returns a shallow copy of the hit object, with its own copy of each list,
+    dictionary and set attribute, e.g. all_branches, so that changing these
+    on the copy leaves the original as it was.  The arrays are shared.
+    """
+    hits_copy = copy.copy(hits)
+    for name, value in vars(hits).items():
+        if isinstance(value, (list, dict, set)):
+            setattr(hits_copy, name, copy.copy(value))
+    return hits_copy
 
-# TODO inheret the MutableSequence attributes of the data directly
-#    def __getitem__(self, key)
-#    def __setitem__(self, key)
-#    def __len__(self, key)
+def concatenate_hits(all_hits, rebase_keys=False):
+    """
+    Returns a hit object holding the hits of all the given hit objects of the
+    same class, with the events of each following those of the one before.
+    The event and hit indexes are re-based onto the combined sample.
+
+    :param all_hits: list of hit objects to combine
+    :param rebase_keys: shift the key values, i.e. the event numbers, of each
+                        object to start after the largest key of the one
+                        before, for when files repeat event numbers
+    """
+    for these_hits in all_hits:
+        these_hits.load_lazy_branches()
+    # Take the naming conventions and geometry from the first object
+    hits = _copy_hits(all_hits[0])
+    names = hits.data.names
+    for these_hits in all_hits[1:]:
+        missing = [name for name in names if name not in these_hits.data]
+        if missing:
+            raise ValueError("ERROR: hits to concatenate are missing the "
+                             "columns {}".format(missing))
+    # Shift the keys if needed
+    key_columns = [these_hits.data[hits.key_name] for these_hits in all_hits]
+    event_keys = [these_hits.event_keys for these_hits in all_hits]
+    if rebase_keys:
+        key_shift = 0
+        for col, key_column in enumerate(key_columns):
+            key_columns[col] = key_column + key_shift
+            event_keys[col] = event_keys[col] + key_shift
+            if len(key_column):
+                key_shift = max(key_columns[col].max(),
+                                event_keys[col].max()) + 1
+    # Stack the data column by column
+    columns = []
+    for name in names:
+        if name == hits.key_name:
+            columns.append(np.concatenate(key_columns))
+        else:
+            columns.append(np.concatenate([these_hits.data[name]
+                                           for these_hits in all_hits]))
+    hits.data = HitData(columns, names=names)
+    # Reset the lookup tables and indexes for the combined sample
+    hits.event_to_n_hits = np.concatenate([these_hits.event_to_n_hits
+                                           for these_hits in all_hits])
+    hits.event_keys = np.concatenate(event_keys)
+    hits._event_key_index = None
+    hits._bitmap_indexes = None
+    hits._event_summary = None
+    hits._reset_all_internal_data()
+    return hits
 
 class GeomHits(FlatHits):
     # pylint: disable=too-many-instance-attributes
@@ -558,8 +1595,23 @@ class GeomHits(FlatHits):
         :param signal_coding: value in hit_type_name branch that signifies a
                               signal hit
         """
+        # Get the reader here, since branches are checked before the base
+        # class is initialized
+        self.reader = get_reader(kwargs.pop("reader", None))
+        # Get the geometry of the detector
+        self.geom = geom
         # Name the trigger data row
         self.trig_name = prefix + trig_name
+        # Name the geometry and measurement rows so that they can be imported
+        # with the rest of the branches
+        self.row_name = prefix + row_name
+        self.idx_name = prefix + idx_name
+        self.flat_name = prefix + flat_name
+        self.edep_name = prefix + edep_name
+        self.time_name = prefix + time_name
+        # Name the layer of each hit, derived from the flat ID, for its
+        # bitmap index
+        self.layer_name = prefix + "layer"
         # Add trig name to branches
         branches, empty_branches = self._add_name_to_branches(path,
                                                               tree,
@@ -575,16 +1627,9 @@ class GeomHits(FlatHits):
                           empty_branches=empty_branches,
                           prefix=prefix,
                           finalize_data=False,
+                          reader=self.reader,
                           **kwargs)
 
-        # Get the geometry flat_IDs
-        self.row_name = self.prefix + row_name
-        self.idx_name = self.prefix + idx_name
-        self.flat_name = self.prefix + flat_name
-
-        # Get the geometry of the detector
-        self.geom = geom
-
         # Build the flattened ID row
         geom_column = self._get_geom_flat_ids(path, tree=tree)
 
@@ -592,10 +1637,6 @@ class GeomHits(FlatHits):
         self.data.append(geom_column)
         self.all_branches.append(self.flat_name)
 
-        # Define the names of the time and energy depostition columns
-        self.edep_name = self.prefix + edep_name
-        self.time_name = self.prefix + time_name
-
         # Import these, noting this will be ignored if they already exist
         edep_column = self._import_root_file(path, tree=tree,
                                              branches=[self.edep_name])
@@ -614,12 +1655,32 @@ class GeomHits(FlatHits):
 
     def _finalize_data(self):
         """
-        Zip up the data into a rec array if this is the highest level class of
-        this instance and sort by time
+        Zip up the data into a HitData container if this is the highest level
+        class of this instance and sort by time
         """
         super(GeomHits, self)._finalize_data()
         self.sort_hits(self.time_name)
 
+    def _get_import_branches(self, path, tree):
+        """
+        Returns the geometry, energy deposition and timing branches
+        """
+        return [self.row_name, self.idx_name, self.edep_name, self.time_name]
+
+    def _get_compact_dtypes(self):
+        """
+        Returns the dtype of each column in compact mode, adding unsigned
+        geometry IDs and 32 bit energy depositions and times
+        """
+        dtypes = super(GeomHits, self)._get_compact_dtypes()
+        dtypes[self.flat_name] = np.min_scalar_type(self.geom.n_points - 1)
+        for name in [self.row_name, self.idx_name]:
+            if name in self.data:
+                dtypes[name] = _narrowest_int_dtype(self.data[name])
+        for name in [self.edep_name, self.time_name, self.trig_name]:
+            dtypes[name] = np.float32
+        return dtypes
+
     def _get_geom_flat_ids(self, path, tree):
         """
         Labels each hit by flattened geometry ID to replace the use of volume
@@ -630,12 +1691,237 @@ class GeomHits(FlatHits):
                                                     branches=[self.row_name,
                                                               self.idx_name])
         # Flatten the volume names and IDs to flat_voldIDs
-        flat_ids = np.zeros(self.n_hits)
-        for row, idx, hit in zip(row_data, idx_data, list(range(self.n_hits))):
-            flat_ids[hit] = self.geom.point_lookup[row, idx]
-        # Save this column and name it
-        flat_id_column = flat_ids.astype(int)
-        return flat_id_column
+        return self._lookup_flat_ids(row_data, idx_data)
+
+    def _lookup_flat_ids(self, row_data, idx_data):
+        """
+        Maps the row and index of each hit to its flattened geometry ID,
+        checking all hits lie inside the geometry
+        """
+        row_data = np.asarray(row_data, dtype=int)
+        idx_data = np.asarray(idx_data, dtype=int)
+        # Find the hits outside of the lookup table
+        n_rows, n_idxs = self.geom.point_lookup.shape
+        bad_hits = (row_data < 0) | (row_data >= n_rows) |\
+                   (idx_data < 0) | (idx_data >= n_idxs)
+        flat_ids = np.full(len(row_data), -1, dtype=int)
+        flat_ids[~bad_hits] = self.geom.point_lookup[row_data[~bad_hits],
+                                                     idx_data[~bad_hits]]
+        # Rows shorter than the longest row are padded with -1
+        bad_hits |= flat_ids < 0
+        assert not bad_hits.any(),\
+            "ERROR: {} hits are outside the geometry\n".format(bad_hits.sum())+\
+            "Rows {}: {}\n".format(self.row_name, row_data[bad_hits][:10])+\
+            "Indexes {}: {}\n".format(self.idx_name, idx_data[bad_hits][:10])
+        return flat_ids
+
+    def _get_bitmap_defaults(self):
+        """
+        Returns the columns indexed when bitmap_indexes is True, adding the
+        layer of each hit
+        """
+        return super(GeomHits, self)._get_bitmap_defaults() + [self.layer_name]
+
+    def _get_bitmap_column(self, name):
+        """
+        Returns the values of an indexed column, deriving the layer of each
+        hit from its flat ID
+        """
+        if name == self.layer_name:
+            return self.geom.point_layers[self.data[self.flat_name]]
+        return super(GeomHits, self)._get_bitmap_column(name)
+
+    def _get_bitmap_sources(self, name):
+        """
+        Returns the columns the values of an indexed column are taken from,
+        where the layer is taken from the flat ID
+        """
+        if name == self.layer_name:
+            return [self.flat_name]
+        return super(GeomHits, self)._get_bitmap_sources(name)
+
+    def _column_changed(self, name):
+        """
+        Drop the bitmap indexes, and the event summary, built from a column of
+        the data once it is assigned, added or removed
+        """
+        super(GeomHits, self)._column_changed(name)
+        if name in [self.flat_name, self.hit_type_name, self.edep_name,
+                    self.trig_name]:
+            self.invalidate_event_summary()
+
+    def get_layer_hits(self, layers, events=None):
+        """
+        Returns the hits in the given layer(s) from the given event(s).
+        Default gets hits from all events.
+        """
+        these_hits = self._get_indexed_hits(self.layer_name, layers, events)
+        if these_hits is not None:
+            return these_hits
+        these_hits = self.get_events(events)
+        hit_layers = self.geom.point_layers[these_hits[self.flat_name]]
+        return these_hits[np.isin(hit_layers, layers)]
+
+    def _count_event_vols(self, hit_events, hit_vols):
+        """
+        Returns the number of unique volumes hit in each event
+
+        :param hit_events: event of each hit
+        :param hit_vols: flat ID of each hit
+        """
+        evt_vols = np.unique(hit_events * self.geom.n_points + hit_vols)
+        return np.bincount(evt_vols // self.geom.n_points,
+                           minlength=self.n_events)
+
+    def get_event_summary(self):
+        """
+        Returns a table of aggregates of the hits of each event, with one row
+        per event and the columns
+
+         - n_hits: number of hits
+         - n_vols, n_sig_vols, n_bkg_vols: number of unique volumes with any,
+           signal and background hits
+         - max_layer, min_layer: highest and lowest layer hit
+         - charge_sum: sum of the edep_name column, the charge by default
+         - trig_time: trigger time, see get_event_trigger_times
+
+        The table is built with one pass over the hits and cached.  Removing
+        whole events keeps the rows of the remaining events.  It is not
+        updated row by row otherwise: trims that remove some of the hits of an
+        event, adding hits, setting the trigger time, and assigning a column
+        it is built from drop the table, and it is recomputed on the next
+        call.  See invalidate_event_summary for changes made in place.
+
+        :return: HitData of shape [self.n_events]
+        """
+        if self._event_summary is not None:
+            return self._event_summary
+        hit_events = np.repeat(np.arange(self.n_events), self.event_to_n_hits)
+        hit_vols = self.data[self.flat_name].astype(np.int64)
+        is_sig = self.data[self.hit_type_name] == self.signal_coding
+        # Reduce the layers over the hits of each non-empty event
+        max_layer = np.full(self.n_events, -1)
+        min_layer = np.full(self.n_events, -1)
+        has_hits = self.event_to_n_hits > 0
+        if has_hits.any():
+            hit_layers = self.geom.point_layers[hit_vols]
+            evt_starts = self.event_offsets[:-1][has_hits]
+            max_layer[has_hits] = np.maximum.reduceat(hit_layers, evt_starts)
+            min_layer[has_hits] = np.minimum.reduceat(hit_layers, evt_starts)
+        self._event_summary = HitData(dict(
+            n_hits=self.event_to_n_hits,
+            n_vols=self._count_event_vols(hit_events, hit_vols),
+            n_sig_vols=self._count_event_vols(hit_events[is_sig],
+                                              hit_vols[is_sig]),
+            n_bkg_vols=self._count_event_vols(hit_events[~is_sig],
+                                              hit_vols[~is_sig]),
+            max_layer=max_layer,
+            min_layer=min_layer,
+            charge_sum=np.bincount(hit_events,
+                                   weights=self.data[self.edep_name],
+                                   minlength=self.n_events),
+            trig_time=self.get_event_trigger_times()))
+        return self._event_summary
+
+    def get_event_trigger_times(self):
+        """
+        Returns the trigger time of each event, or NaN for events without a
+        trigger.  Events with several trigger times, e.g. after overlaying
+        events that were already triggered, return the earliest.  The trigger
+        time must be set first, see CTHHits.set_trigger_time.
+
+        :return: numpy.array of shape [self.n_events]
+        """
+        trig_times = self.data[self.trig_name]
+        trig_hits = np.flatnonzero(trig_times != 0)
+        trig_events = np.repeat(np.arange(self.n_events),
+                                self.event_to_n_hits)[trig_hits]
+        evt_trig_times = np.full(self.n_events, np.inf)
+        np.minimum.at(evt_trig_times, trig_events, trig_times[trig_hits])
+        evt_trig_times[np.isinf(evt_trig_times)] = np.nan
+        return evt_trig_times
+
+    def _is_time_sorted(self):
+        """
+        Returns true if the hits of each event are sorted by time
+        """
+        return list(self._sorted_by[:1]) == [self.time_name]
+
+    def get_time_windows(self, lower=None, upper=None, events=None):
+        """
+        Returns the range of hits [start, stop) in each event with
+        lower < time < upper.  The ranges are found by bisecting the time
+        sorted hits of all the events at once, without scanning the hits.
+        The range is empty if either edge is NaN, or if lower >= upper.
+
+        :param lower: lower edge of the window, either one value or one value
+                      per event.  Default is no lower edge
+        :param upper: upper edge of the window, as for lower
+        :param events: event indexes, default is all events
+        :return: tuple of numpy.arrays (starts, stops) of hit indexes
+        """
+        assert self._is_time_sorted(),\
+            "ERROR: the hits must be sorted by {} inside each event to use "\
+            "time windows, see sort_hits".format(self.time_name)
+        if events is None:
+            events = np.arange(self.n_events)
+        events = np.atleast_1d(events)
+        starts = self.event_offsets[events]
+        stops = self.event_offsets[events + 1]
+        times = self.data[self.time_name]
+        if lower is not None:
+            starts = _segment_searchsorted(times, starts, stops, lower,
+                                           side="right")
+        if upper is not None:
+            stops = _segment_searchsorted(times, starts, stops, upper,
+                                          side="left")
+        # Empty the windows with a NaN edge, which no time is inside, and
+        # those with the edges the wrong way round
+        stops = np.maximum(stops, starts)
+        for edge in [lower, upper]:
+            if edge is not None:
+                is_nan = np.isnan(np.asarray(edge, dtype=float))
+                is_nan = np.broadcast_to(is_nan, starts.shape)
+                stops = np.where(is_nan, starts, stops)
+        return starts, stops
+
+    def get_time_window_hits(self, lower=None, upper=None, events=None):
+        """
+        Returns the hits of the given event(s) with lower < time < upper.  A
+        single event returns a view of its hits in the window.  See
+        get_time_windows.
+        """
+        if isinstance(events, (int, np.integer)):
+            (start,), (stop,) = self.get_time_windows(lower, upper, events)
+            return self.data[start:stop]
+        starts, stops = self.get_time_windows(lower, upper, events)
+        return self.data[_ranges_to_indexes(starts, stops)]
+
+    def trim_time_window(self, lower=None, upper=None):
+        """
+        Keep the hits with lower < time < upper, where lower and upper are
+        either one value or one value per event.  If the hits are sorted by
+        time, the hits kept are found from the window edges of each event.
+        Events whose window edges are NaN lose all their hits.
+        """
+        if self._is_time_sorted():
+            starts, stops = self.get_time_windows(lower, upper)
+            # Mark the start and end of each window, then fill them in
+            n_edges = self.n_hits + 1
+            in_window = np.bincount(starts, minlength=n_edges) - \
+                        np.bincount(stops, minlength=n_edges)
+            self._keep_hits(np.cumsum(in_window)[:-1] > 0)
+            return
+        # Otherwise compare every hit to the window of its event
+        times = self.data[self.time_name]
+        mask = np.ones(self.n_hits, dtype=bool)
+        if lower is not None:
+            lower = np.broadcast_to(lower, (self.n_events,))
+            mask &= times > np.repeat(lower, self.event_to_n_hits)
+        if upper is not None:
+            upper = np.broadcast_to(upper, (self.n_events,))
+            mask &= times < np.repeat(upper, self.event_to_n_hits)
+        self._keep_hits(mask)
 
     def get_measurement(self, events, name):
         """
@@ -835,6 +2121,17 @@ class CDCHits(GeomHits):
         else:
             return super(CDCHits, self)._get_geom_flat_ids(path, tree)
 
+    def _get_import_branches(self, path, tree):
+        """
+        Returns the energy deposition and timing branches, with the channel
+        branch in place of the geometry branches if it is present
+        """
+        has_chan = self._check_for_branches(path, tree,
+                                            branches=[self.chan_name],
+                                            soft_check=True)
+        if has_chan:
+            return [self.chan_name, self.edep_name, self.time_name]
+        return super(CDCHits, self)._get_import_branches(path, tree)
 
     def get_measurement(self, name, events=None, shift=None, default=0,
                         only_hits=True, flatten=False, use_sparse=False):
@@ -936,30 +2233,22 @@ class CDCHits(GeomHits):
 
     def min_layer_cut(self, min_layer):
         """
-        Returns the EventNumbers of the events that pass the min_layer criterium
+        Returns the EventNumbers of the events that pass the min_layer criterium.
+        These are the event keys, see get_event_keys, so hits added from other
+        events do not change them.
         """
         # Filter for max layer
-        evt_max = np.zeros(self.n_events)
-        for event in range(self.n_events):
-            evt_hits = self.get_measurement(self.flat_name,
-                                            events=event,
-                                            flatten=False,
-                                            only_hits=False).astype(int)
-            evt_max[event] = np.amax(self.geom.point_layers[evt_hits])
-        good_event_idx = np.where(evt_max >= min_layer)
-        # TODO these should not return key name, this is dangeous for hit
-        # merging
-        return np.unique(self.get_events(events=good_event_idx)[self.key_name])
+        evt_max = self.get_event_summary()["max_layer"]
+        return np.unique(self.get_event_keys()[evt_max >= min_layer])
 
     def min_hits_cut(self, min_hits):
         """
-        Returns the EventNumbers of the events that pass the min_hits criterium
+        Returns the EventNumbers of the events that pass the min_hits criterium.
+        These are the event keys, see get_event_keys.
         """
         # Filter for number of signal hits
-        good_events = np.where(self.event_to_n_hits >= min_hits)[0]
-        # TODO these should not return key name, this is dangeous for hit
-        # merging
-        return np.unique(self.get_events(events=good_events)[self.key_name])
+        evt_n_hits = self.get_event_summary()["n_hits"]
+        return np.unique(self.get_event_keys()[evt_n_hits >= min_hits])
 
     def get_occupancy(self):
         """
@@ -969,11 +2258,10 @@ class CDCHits(GeomHits):
         :return: np.array (3, self.n_events) as
             (signal_occupauncy, background_occupancy, total_occupancy)
         """
-        occ = np.zeros((3, self.n_events))
-        for evt in range(self.n_events):
-            occ[0, evt] = len(self.get_sig_vols(evt))
-            occ[1, evt] = len(self.get_bkg_vols(evt))
-            occ[2, evt] = len(self.get_hit_vols(evt))
+        summary = self.get_event_summary()
+        occ = np.vstack([summary["n_sig_vols"],
+                         summary["n_bkg_vols"],
+                         summary["n_vols"]]).astype(float)
 
         # print some information
         avg_n_hits = np.average(self.event_to_n_hits)
@@ -1014,6 +2302,9 @@ class CTHHits(GeomHits):
         :param signal_coding: value in hit_type_name branch that signifies a
                               signal hit
         """
+        # Name the hodoscope module of each hit, 1 for upstream and 0 for
+        # downstream, for its bitmap index
+        self.module_name = prefix + "module"
         GeomHits.__init__(self,
                           CTH(),
                           path,
@@ -1028,15 +2319,16 @@ class CTHHits(GeomHits):
         if finalize_data:
             self._finalize_data()
 
-    def _finalize_data(self):
+    def _get_hit_filters(self):
         """
-        Zip up the data into a rec array if this is the highest level class of
-        this instance and sort by time
+        Removes the passive volumes, i.e. the scintillator light guides, from
+        the hit data.  The light guide and scintillator bits of the channel
+        are both set for these volumes, so they are removed by the reader.
         """
-        super(CTHHits, self)._finalize_data()
-        # Remove passive volumes from the hit data
         # TODO fix passive volume hack
-        self.trim_hits(variable=self.flat_name, values=self.geom.fiducial_crys)
+        passive_bits = "(({} >> 15) & 3) != 3".format(self.row_name)
+        return [HitPredicate(self.flat_name, values=self.geom.fiducial_crys,
+                             selection=passive_bits)]
 
     def _get_geom_flat_ids(self, path, tree):
         """
@@ -1049,14 +2341,37 @@ class CTHHits(GeomHits):
         idx_data = self._import_root_file(path, tree=tree,
                                           branches=[self.idx_name])[0]
         # Map from volume names to row indexes
-        row_data = np.vectorize(self.geom.chan_to_row)(chan_data)
+        row_data = self.geom.chan_to_row(chan_data)
         # Flatten the volume names and IDs to flat_voldIDs
-        flat_ids = np.zeros(self.n_hits)
-        for row, idx, hit in zip(row_data, idx_data, list(range(self.n_hits))):
-            flat_ids[hit] = self.geom.point_lookup[row, idx]
-        # Save this column and name it
-        flat_id_column = flat_ids.astype(int)
-        return flat_id_column
+        return self._lookup_flat_ids(row_data, idx_data)
+
+    def _get_bitmap_defaults(self):
+        """
+        Returns the columns indexed when bitmap_indexes is True, adding the
+        hodoscope module of each hit
+        """
+        return super(CTHHits, self)._get_bitmap_defaults() + [self.module_name]
+
+    def _get_bitmap_column(self, name):
+        """
+        Returns the values of an indexed column, deriving the hodoscope module
+        of each hit from its flat ID
+        """
+        if name == self.module_name:
+            point_modules = np.full(self.geom.n_points, -1, dtype=np.int8)
+            point_modules[self.geom.up_crys] = 1
+            point_modules[self.geom.down_crys] = 0
+            return point_modules[self.data[self.flat_name]]
+        return super(CTHHits, self)._get_bitmap_column(name)
+
+    def _get_bitmap_sources(self, name):
+        """
+        Returns the columns the values of an indexed column are taken from,
+        where the hodoscope module is taken from the flat ID
+        """
+        if name == self.module_name:
+            return [self.flat_name]
+        return super(CTHHits, self)._get_bitmap_sources(name)
 
     def get_events(self, events=None, hodoscope="both"):
         """
@@ -1067,6 +2382,13 @@ class CTHHits(GeomHits):
                hodoscope.startswith("down"),\
                "Hodoscope "+ hodoscope +" selected.  This must be both, "+\
                " upstream, or downstream"
+        # Read the hodoscope from the module index if there is one
+        if not hodoscope.startswith("both"):
+            module = 1 if hodoscope.startswith("up") else 0
+            these_hits = self._get_indexed_hits(self.module_name, module,
+                                                events)
+            if these_hits is not None:
+                return these_hits
         events = super(self.__class__, self).get_events(events)
         if hodoscope.startswith("up"):
             events = self.filter_hits(self.flat_name,
@@ -1081,64 +2403,102 @@ class CTHHits(GeomHits):
     def _find_trigger_signal(self, vol_types):
         """
         Returns the volumes that take part in the trigger pattern given an array
-        of volume types
+        of volume types.  Many events are handled at once by passing one row
+        per event.
 
-        :param vol_types: np.array of shape [self.geom.n_points] whose value is
-                          non-zero for a volume hit
-        :return trig_vols: np.array of shape [self.geom.n_points] whose value is
-                           1 for all volumes that form a trigger shape
+        :param vol_types: np.array of shape [..., self.geom.n_points] whose
+                          value is non-zero for a volume hit
+        :return trig_vols: np.array of shape [..., self.geom.n_points] whose
+                           value is 1 for all volumes that form a trigger shape
         """
         # Get all volumes with pairs
         hit_and_left = np.logical_and(vol_types,
-                                      vol_types[self.geom.shift_wires(1)])
+                                      vol_types[...,
+                                                self.geom.shift_wires(1)])
         hit_and_right = np.logical_and(vol_types,
-                                       vol_types[self.geom.shift_wires(-1)])
+                                       vol_types[...,
+                                                 self.geom.shift_wires(-1)])
         trig_crys = np.logical_or(hit_and_left, hit_and_right)
         # Get volumes with crystals hit above or below
-        on_top = np.logical_and(trig_crys[self.geom.cher_crys],
-                                trig_crys[self.geom.scin_crys])
-        trig_crys[self.geom.cher_crys] = on_top
-        trig_crys[self.geom.scin_crys] = on_top
+        on_top = np.logical_and(trig_crys[..., self.geom.cher_crys],
+                                trig_crys[..., self.geom.scin_crys])
+        trig_crys[..., self.geom.cher_crys] = on_top
+        trig_crys[..., self.geom.scin_crys] = on_top
         # Include the crystals to the left and right of these volumes
         trig_crys = np.logical_or.reduce((trig_crys,
-                                          trig_crys[self.geom.shift_wires(1)],
-                                          trig_crys[self.geom.shift_wires(-1)]))
+                                          trig_crys[...,
+                                                    self.geom.shift_wires(1)],
+                                          trig_crys[...,
+                                                    self.geom.shift_wires(-1)]))
         # Return the volumes that pass and have hits
         return np.logical_and(vol_types, trig_crys)
 
+    def _get_trigger_hits(self, hit_events, events_per_block=10000):
+        """
+        Returns the boolean mask of the hits in volumes that form a trigger
+        pattern in their event.  The occupancy matrix of shape
+        [events, self.geom.n_points] is built for a block of events at a time
+        to bound the memory used.
+
+        :param hit_events: event of each hit
+        :param events_per_block: number of events in each block
+        """
+        hit_vols = self.data[self.flat_name]
+        trig_hits = np.zeros(self.n_hits, dtype=bool)
+        for start in range(0, self.n_events, events_per_block):
+            stop = min(start + events_per_block, self.n_events)
+            first_hit = self.event_offsets[start]
+            last_hit = self.event_offsets[stop]
+            block_events = hit_events[first_hit:last_hit] - start
+            block_vols = hit_vols[first_hit:last_hit]
+            # Mark the volumes hit in each event
+            vol_types = np.zeros((stop - start, self.geom.n_points),
+                                 dtype=bool)
+            vol_types[block_events, block_vols] = True
+            trig_vols = self._find_trigger_signal(vol_types)
+            trig_hits[first_hit:last_hit] = trig_vols[block_events, block_vols]
+        return trig_hits
 
     def set_trigger_time(self):
+        """
+        Emulates the trigger for every event.  The trigger time of an event is
+        the time of the hit where the fourth volume of the trigger pattern is
+        first hit, or as close after it as possible.  It is stored on every hit
+        of the volumes in the pattern, and is zero for the other hits.
+        """
         # Sort by time first
         self.sort_hits(self.time_name)
-        # Reset the trigger timing
+        # Reset the trigger timing, and the event summary holding it
         self.data[self.trig_name] = 0
-        for event in range(self.n_events):
-            # Get the volumes with hits for these events
-            vol_types = self.get_vol_types(event)
-            trig_vols = np.nonzero(self._find_trigger_signal(vol_types))[0]
-            # Skip the event if there is no trigger
-            if len(trig_vols) == 0:
-                continue
-            # Find the hit indexes of all the volumes that have hits
-            trig_hits = self.filter_hits(self.flat_name,
-                                         these_hits=self.get_events(event),
-                                         values=trig_vols)[self.hits_index_name]
-            # Get the indexes where these volumes first appear in the
-            # (event,time) sorted data
-            _, uniq_idxs = np.unique(self.data[self.flat_name][trig_hits],
-                                     return_index=True)
-            # Get as close to the fourth hit as possible, but not less
-            uniq_idxs = uniq_idxs[uniq_idxs > 2]
-            try:
-                fourth_uniq_hit = uniq_idxs[(np.abs(uniq_idxs-3)).argmin()]
-                fourth_vol_hit = trig_hits[fourth_uniq_hit]
-            except:
-                print("Error in trigger logic!!\n"+\
-                      "Trig vols : {}\n".format(trig_vols)+\
-                      "Uniq idx : {}\n".format(uniq_idxs)+\
-                      "Event : {}".format(event))
-            self.data[self.trig_name][trig_hits] = \
-                    self.data[self.time_name][fourth_vol_hit]
+        self.invalidate_event_summary()
+        hit_events = np.repeat(np.arange(self.n_events), self.event_to_n_hits)
+        # Get the hits in trigger volumes, in (event, time) order
+        trig_hits = np.flatnonzero(self._get_trigger_hits(hit_events))
+        if len(trig_hits) == 0:
+            return
+        trig_events = hit_events[trig_hits]
+        # Rank the trigger hits inside each event
+        n_trig_hits = np.bincount(trig_events, minlength=self.n_events)
+        trig_starts = np.cumsum(n_trig_hits) - n_trig_hits
+        trig_ranks = np.arange(len(trig_hits)) - trig_starts[trig_events]
+        # Get the trigger hits where each volume first appears in its event
+        trig_keys = trig_events * self.geom.n_points + \
+                    self.data[self.flat_name][trig_hits]
+        _, first_hits = np.unique(trig_keys, return_index=True)
+        # Get as close to the fourth hit as possible, but not less, which is the
+        # earliest such first appearance in each event
+        first_hits = np.sort(first_hits[trig_ranks[first_hits] > 2])
+        trig_evts, fourth_hits = np.unique(trig_events[first_hits],
+                                           return_index=True)
+        evt_trig_times = np.zeros(self.n_events)
+        evt_trig_times[trig_evts] = \
+                self.data[self.time_name][trig_hits[first_hits[fourth_hits]]]
+        # Only mark the events with a trigger
+        has_trig = np.zeros(self.n_events, dtype=bool)
+        has_trig[trig_evts] = True
+        trig_hits = trig_hits[has_trig[trig_events]]
+        self.data[self.trig_name][trig_hits] = \
+                evt_trig_times[hit_events[trig_hits]]
 
 # TODO move these into get measurement
 
@@ -1156,9 +2516,12 @@ class CTHHits(GeomHits):
         """
         Return the trigger events by EventNumber
         """
-        # Find the hit indexes of all the volumes that have hits
-        # TODO have this not return keyname, this is dangerous for hit merging
-        return np.unique(self.data[self.get_trig_hits(events)][self.key_name])
+        # Take the keys of the events of the trigger hits, rather than the keys
+        # of the hits themselves, which may have been added from other events
+        trig_events = self._get_hit_events()[self.data[self.trig_name] != 0]
+        if events is not None:
+            trig_events = trig_events[np.in1d(trig_events, events)]
+        return np.unique(self.get_event_keys()[trig_events])
 
     def get_trig_vector(self, events):
         """
@@ -1195,29 +2558,84 @@ class CyDetHits(FlatHits):
             self.keep_common_events()
         self.n_events = min(self.cdc.n_events, self.cth.n_events)
 
+    def event_view(self, event):
+        """
+        Returns views of the CDC hits of one event and of the CTH hits of the
+        event with the same key, which is empty if there is none.  The CDC and
+        CTH events are matched by key since their event indexes differ once
+        either is trimmed on its own.
+        """
+        cdc_view = self.cdc.event_view(event)
+        cth_event = self.cth.get_event_slots(self.cdc.get_event_keys()[event])
+        if cth_event[0] < 0:
+            return cdc_view, self.cth.data[0:0]
+        return cdc_view, self.cth.event_view(cth_event[0])
+
+    def iter_events(self, events=None):
+        """
+        Iterate over views of the CDC and CTH hits of each CDC event, see
+        event_view.  Default is all CDC events in order.
+        """
+        if events is None:
+            events = range(self.cdc.n_events)
+        for event in events:
+            yield self.event_view(event)
+
+    def __getitem__(self, key):
+        """
+        Returns the CDC hits of the events, see FlatHits.__getitem__, and the
+        CTH hits of the events with the same keys.  hits[name] returns the
+        column of each.
+        """
+        if isinstance(key, str):
+            return self.cdc[key], self.cth[key]
+        if isinstance(key, (int, np.integer)):
+            return self.event_view(key)
+        events = np.arange(self.cdc.n_events)[key]
+        cth_events = self.cth.get_event_slots(
+            self.cdc.get_event_keys()[events])
+        cth_hits = self.cth.get_hit_indexes(cth_events[cth_events >= 0])
+        return self.cdc[key], self.cth.data[cth_hits]
+
     def keep_common_events(self):
         """
         Trim all events by event index so that they have the same events
         """
-        shared_evts = np.intersect1d(self.cdc.get_events()[self.cdc.key_name],
-                                     self.cth.get_events()[self.cth.key_name])
+        # Intersect the keys of each event rather than of each hit
+        shared_evts = np.intersect1d(self.cdc.get_event_keys(),
+                                     self.cth.get_event_keys())
         self.trim_events(shared_evts)
 
+    def _get_event_trigger_times(self, hits):
+        """
+        Returns the CTH trigger time of each event of the hit object, matching
+        the events by key.  Events without a trigger, or without CTH hits,
+        are NaN.  See CTHHits.get_event_trigger_times.
+
+        :param hits: hit object whose events are returned, i.e. cdc or cth
+        :return: numpy.array of shape [hits.n_events]
+        """
+        trig_times = self.cth.get_event_trigger_times()
+        evt_trig_times = np.full(hits.n_events, np.nan)
+        cth_slots = self.cth.get_event_slots(hits.get_event_keys())
+        has_event = cth_slots >= 0
+        evt_trig_times[has_event] = trig_times[cth_slots[has_event]]
+        return evt_trig_times
+
     def set_trigger_time(self):
         """
-        Set the CTH trigger time for both the CTH and for all CDC hits
+        Set the CTH trigger time for both the CTH and for all CDC hits.  The
+        CDC hits of events without a trigger are given a trigger time of zero,
+        as are the CTH hits, and events with several triggers use the earliest.
         """
         # Set the CTH trigger time
         self.cth.set_trigger_time()
-        # Broadcase this value to all CDC hits in the event
-        for event in range(self.cth.n_events):
-            # Get all the trigger times in  this event
-            all_trig = np.unique(self.cth.get_events(event)[self.cth.trig_name])
-            # Remove the zero values
-            evt_trig = np.trim_zeros(all_trig)
-            # Broadcast this value to all CDC hits in this event
-            self.cdc.data[self.cdc.trig_name][self.cdc.event_to_hits[event]] = \
-                evt_trig
+        # Broadcast the trigger time of each event to all its CDC hits
+        evt_trig_times = self._get_event_trigger_times(self.cdc)
+        evt_trig_times[np.isnan(evt_trig_times)] = 0
+        self.cdc.data[self.cdc.trig_name] = \
+                np.repeat(evt_trig_times, self.cdc.event_to_n_hits)
+        self.cdc.invalidate_event_summary()
 
     def print_branches(self):
         """
@@ -1229,6 +2647,26 @@ class CyDetHits(FlatHits):
         print("CDC Branches:")
         self.cdc.print_branches()
 
+    def save(self, path):
+        """
+        Save the CDC and CTH hits to the cdc and cth sub-directories of path
+        """
+        self.cdc.save(os.path.join(path, "cdc"))
+        self.cth.save(os.path.join(path, "cth"))
+        _write_metadata(path, {"class" : self.__class__.__name__,
+                               "attributes" : _json_attributes(self)})
+
+    @classmethod
+    def load(cls, path, mmap=False):
+        """
+        Load CDC and CTH hits saved by save(path)
+        """
+        meta, hit_class = _read_metadata(path, cls)
+        hits = hit_class(FlatHits.load(os.path.join(path, "cdc"), mmap=mmap),
+                         FlatHits.load(os.path.join(path, "cth"), mmap=mmap))
+        hits.__dict__.update(meta["attributes"])
+        return hits
+
     def trim_events(self, events):
         """
         Keep these events in the data
@@ -1237,11 +2675,32 @@ class CyDetHits(FlatHits):
         self.cth.trim_events(events)
         self.n_events = self.cdc.n_events
 
+    @contextmanager
+    def batch_trims(self):
+        """
+        Defer resetting the CDC and CTH indexes until the end of a batch of
+        trims
+        """
+        with self.cdc.batch_trims(), self.cth.batch_trims():
+            yield self
+
     def apply_timing_cut(self, lower=700, upper=1170, drift=450):
         """
         Remove the hits that do not pass timing cut
         """
-        self.cth.trim_hits(variable=self.cth.time_name,\
-                           greater_than=lower, less_than=upper)
-        self.cdc.trim_hits(variable=self.cdc.time_name,\
-                           greater_than=lower, less_than=upper+drift)
+        self.cth.trim_time_window(lower, upper)
+        self.cdc.trim_time_window(lower, upper + drift)
+
+    def apply_trigger_window(self, before, after, drift=0):
+        """
+        Remove the hits outside of a window around the CTH trigger time of
+        their event, i.e. trig_time - before < time < trig_time + after, with
+        the upper edge of the CDC window extended by the drift time.  Events
+        without a trigger lose all their hits.  The CTH trigger time must be
+        set first, see CTHHits.set_trigger_time.
+        """
+        for hits, extra in [(self.cth, 0), (self.cdc, drift)]:
+            evt_trig_times = self._get_event_trigger_times(hits)
+            hits.trim_time_window(evt_trig_times - before,
+                                  evt_trig_times + after + extra)
+        self.n_events = self.cdc.n_events
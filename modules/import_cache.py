@@ -0,0 +1,175 @@
+import os
+import shutil
+import hashlib
+import inspect
+import tempfile
+import numpy as np
+"""
+On-disk cache of hit objects imported from root files.  Each entry is a
+directory written by the save method of the hit class, named by a hash of the
+source file and the constructor arguments.
+"""
+
+# Version of the saved format of the hit classes, which is part of every
+# cache key so that entries written in an older format are never read.
+# Increase it whenever save or the data it writes changes.
+CACHE_FORMAT_VERSION = 2
+
+def _key_value(value):
+    """
+    Returns a representation of a constructor argument for the cache key,
+    which depends on the value of the argument.  Raises a TypeError for
+    objects whose value cannot be represented.
+    """
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return repr(value)
+    # Key numpy values by the python values they hold
+    if isinstance(value, (np.generic, np.ndarray)):
+        return _key_value(value.tolist())
+    # Objects that know how to identify themselves, e.g. HitPredicate
+    if hasattr(value, "cache_key"):
+        return value.cache_key()
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(_key_value(val) for val in value) + "]"
+    if isinstance(value, dict):
+        return "{" + ", ".join(_key_value(key) + ": " + _key_value(value[key])
+                               for key in sorted(value)) + "}"
+    raise TypeError("ERROR: cannot build an import cache key from an "
+                    "argument of type {}".format(type(value).__name__))
+
+def _bind_arguments(hit_class, args, kwargs):
+    """
+    Returns all the arguments a hit class would be constructed with, including
+    the defaults, with any keyword arguments passed through to the base classes
+    flattened in
+    """
+    signature = inspect.signature(hit_class.__init__)
+    bound = signature.bind(None, *args, **kwargs)
+    bound.apply_defaults()
+    arguments = dict(bound.arguments)
+    for name, param in signature.parameters.items():
+        if param.kind == param.VAR_KEYWORD:
+            arguments.update(arguments.pop(name))
+    # Drop self
+    arguments.pop(list(signature.parameters)[0])
+    return arguments
+
+def _entry_size(entry):
+    """
+    Returns the total size of the files in a cache entry in bytes
+    """
+    return sum(os.path.getsize(os.path.join(entry, name))
+               for name in os.listdir(entry))
+
+class ImportCache(object):
+    def __init__(self, cache_dir, max_bytes=20 * 1024**3, mmap=True):
+        """
+        A cache of imported hit objects stored in cache_dir.  Entries are keyed
+        by the source file's path, size and modification time, the hit class,
+        and every constructor argument, i.e. the tree, selection, branches,
+        empty_branches and n_evts, as well as CACHE_FORMAT_VERSION.  Objects
+        taken from the cache are restored by the load method of the hit class,
+        including the reader they were imported with.  When the cache grows
+        past max_bytes, the least recently used entries are removed.
+
+        :param cache_dir: directory to store the cache in, created if needed
+        :param max_bytes: disk budget of the cache in bytes
+        :param mmap: memory-map the cached columns when loading an entry
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.mmap = mmap
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def make_key(self, hit_class, args, kwargs):
+        """
+        Returns the cache key of a hit class constructed with these arguments
+        """
+        arguments = _bind_arguments(hit_class, args, kwargs)
+        path = arguments.pop("path")
+        path_stat = os.stat(path)
+        key_parts = ["format={}".format(CACHE_FORMAT_VERSION),
+                     hit_class.__name__, os.path.abspath(path),
+                     repr(path_stat.st_size), repr(path_stat.st_mtime)]
+        key_parts += [name + "=" + _key_value(arguments[name])
+                      for name in sorted(arguments)]
+        return hashlib.sha1("\n".join(key_parts).encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key, hit_class):
+        """
+        Returns the cached hit object for this key, or None if it is not cached
+        """
+        entry = self._entry_path(key)
+        if not os.path.isfile(os.path.join(entry, "meta.json")):
+            return None
+        # Mark the entry as recently used
+        os.utime(entry, None)
+        return hit_class.load(entry, mmap=self.mmap)
+
+    def put(self, key, hits):
+        """
+        Store the hit object under this key, then evict the least recently
+        used entries if the cache is over its disk budget
+        """
+        entry = self._entry_path(key)
+        # Write to a temporary directory first so that a partially written
+        # entry is never read
+        tmp_entry = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp_")
+        try:
+            hits.save(tmp_entry)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.rename(tmp_entry, entry)
+        finally:
+            if os.path.isdir(tmp_entry):
+                shutil.rmtree(tmp_entry)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache fits in its disk
+        budget.  The entry named by keep is never removed.
+        """
+        entries = [self._entry_path(key) for key in os.listdir(self.cache_dir)
+                   if not key.startswith(".")]
+        entries = sorted(entries, key=os.path.getmtime)
+        sizes = dict((entry, _entry_size(entry)) for entry in entries)
+        total_size = sum(sizes.values())
+        for entry in entries:
+            if total_size <= self.max_bytes:
+                break
+            if keep is not None and entry == self._entry_path(keep):
+                continue
+            shutil.rmtree(entry)
+            total_size -= sizes[entry]
+
+    def clear(self):
+        """
+        Remove all entries from the cache
+        """
+        for key in os.listdir(self.cache_dir):
+            shutil.rmtree(self._entry_path(key))
+
+class CachedImport(type):
+    """
+    Metaclass that lets hit classes be taken from an ImportCache.  Passing
+    cache=ImportCache(...), or cache=<directory>, to the constructor returns
+    the cached object if there is one, and otherwise builds the object and
+    stores it in the cache.
+    """
+    def __call__(cls, *args, **kwargs):
+        cache = kwargs.pop("cache", None)
+        if cache is None:
+            return super(CachedImport, cls).__call__(*args, **kwargs)
+        if not isinstance(cache, ImportCache):
+            cache = ImportCache(cache)
+        key = cache.make_key(cls, args, kwargs)
+        hits = cache.get(key, cls)
+        if hits is None:
+            hits = super(CachedImport, cls).__call__(*args, **kwargs)
+            cache.put(key, hits)
+        return hits
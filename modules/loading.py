@@ -0,0 +1,72 @@
+from concurrent.futures import ProcessPoolExecutor
+from hits import concatenate_hits, GEOMETRIES
+"""
+Loading of many hit files at once with a pool of worker processes
+"""
+
+def _load_hits(task):
+    """
+    Builds one hit object in a worker process.  The geometry is dropped before
+    the object is sent back, since it is far larger than the hits of a single
+    file and is the same for every file.
+
+    :param task: tuple of (hit class, path, constructor keyword arguments)
+    :return: tuple of (hit object, name of the geometry class or None)
+    """
+    hit_class, path, kwargs = task
+    hits = hit_class(path, **kwargs)
+    # The lazy branches can only be imported from this process
+    hits.load_lazy_branches()
+    geom = hits.__dict__.pop("geom", None)
+    return hits, type(geom).__name__ if geom is not None else None
+
+def load_files(hit_class, paths, n_workers=None, events_per_chunk=None,
+               rebase_keys=False, **kwargs):
+    """
+    Load the hits of many files with a pool of processes and combine them
+    into one hit object, in the order the files are given.  The event and
+    hit indexes are re-based onto the combined sample.
+
+    :param hit_class: class to build from each file, e.g. CDCHits or CTHHits
+    :param paths: list of paths to the root files
+    :param n_workers: number of worker processes, default is one per core
+    :param events_per_chunk: if given, split each file into ranges of this
+                             many events and give each range to a worker.
+                             Otherwise each worker builds a whole file
+    :param rebase_keys: shift the event numbers of each file to follow on from
+                        the file before, for when files repeat event numbers
+    :param kwargs: arguments passed to the constructor of hit_class
+    """
+    if not isinstance(paths, list):
+        paths = [paths]
+    # Define one task per file, or per event range in each file, recording
+    # the file of each task
+    tasks, task_files = [], []
+    for file_idx, path in enumerate(paths):
+        if events_per_chunk is None:
+            tasks.append((hit_class, path, kwargs))
+            task_files.append(file_idx)
+            continue
+        for start, stop in hit_class.get_chunk_ranges(path, events_per_chunk,
+                                                      **kwargs):
+            tasks.append((hit_class, path,
+                          dict(kwargs, start=start, stop=stop)))
+            task_files.append(file_idx)
+    # Build the hits in parallel, keeping the order of the tasks
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        results = list(pool.map(_load_hits, tasks))
+    all_hits = [hits for hits, _ in results]
+    # Give every object the same geometry, built once here
+    geom_names = set(geom_name for _, geom_name in results)
+    assert len(geom_names) == 1,\
+        "ERROR: files loaded with different geometries {}".format(geom_names)
+    geom_name = geom_names.pop()
+    if geom_name is not None:
+        all_hits[0].geom = GEOMETRIES[geom_name]()
+    # Only rebase the keys between files, not between ranges of the same file
+    if rebase_keys and events_per_chunk is not None:
+        all_hits = [concatenate_hits([hits for hits, task_file
+                                      in zip(all_hits, task_files)
+                                      if task_file == file_idx])
+                    for file_idx in range(len(paths))]
+    return concatenate_hits(all_hits, rebase_keys=rebase_keys)
@@ -0,0 +1,135 @@
+import copy
+import numpy as np
+from hits import CyDetHits
+"""
+Mixing of signal events with bunches of background events
+"""
+
+class EventOverlay(object):
+    def __init__(self, signal, background, n_bunches=1, bunch_offsets=None,
+                 replace=True, seed=None):
+        """
+        Builds mixed events by adding the hits of n_bunches background events,
+        drawn at random from a pool, to each signal event.  The background
+        events of each signal event are chosen up front as a table of event
+        indexes, and the mixed sample is built from it with one gather of the
+        background hits, so the input samples are not changed.  The same seed
+        always gives the same mixed sample.
+
+        :param signal: CyDetHits of the signal events
+        :param background: CDCHits, or CyDetHits, of the pool of background
+                           events.  With CyDetHits, the CTH hits of each
+                           background event are added as well, matching the
+                           events by key.  Signal events without CTH hits
+                           get a CTH event for the background CTH hits
+                           added to them, so none are dropped
+        :param n_bunches: number of background events added to each signal
+                          event
+        :param bunch_offsets: time added to the hits of each bunch, as a list of
+                              n_bunches values.  Default is no offset
+        :param replace: allow a background event to be used more than once
+        :param seed: seed of the random choice of background events
+        """
+        self.signal = signal
+        self.background = background
+        self.n_bunches = n_bunches
+        if bunch_offsets is None:
+            bunch_offsets = np.zeros(n_bunches)
+        self.bunch_offsets = np.asarray(bunch_offsets, dtype=float)
+        assert len(self.bunch_offsets) == self.n_bunches,\
+            "ERROR: {} bunch offsets given for {} bunches".format(
+                len(self.bunch_offsets), self.n_bunches)
+        self.replace = replace
+        self.seed = seed
+        # Choose the background events of each signal event
+        self.background_events = self._choose_background_events()
+
+    def _get_background_cdc(self):
+        """
+        Returns the CDC hits of the background pool
+        """
+        if isinstance(self.background, CyDetHits):
+            return self.background.cdc
+        return self.background
+
+    def _choose_background_events(self):
+        """
+        Returns the table of background event indexes added to each signal
+        event
+
+        :return: numpy.array of shape [signal events, n_bunches]
+        """
+        n_pool = self._get_background_cdc().n_events
+        n_needed = self.signal.cdc.n_events * self.n_bunches
+        assert self.replace or n_needed <= n_pool,\
+            "ERROR: {} background events needed from a pool of {}".format(
+                n_needed, n_pool)
+        random_state = np.random.RandomState(self.seed)
+        return random_state.choice(n_pool,
+                                   size=(self.signal.cdc.n_events,
+                                         self.n_bunches),
+                                   replace=self.replace)
+
+    def _gather_hits(self, background, bkg_events, dest_events, bunches):
+        """
+        Returns the hits of the background events, one event after the other,
+        with the time offset of their bunch added and labelled by the event
+        they are added to
+
+        :param background: hit object of the background pool
+        :param bkg_events: background event index of each added event
+        :param dest_events: event index each added event is added to
+        :param bunches: bunch of each added event
+        """
+        hits = background.data[background.get_hit_indexes(bkg_events)]
+        evt_n_hits = background.event_to_n_hits[bkg_events]
+        hits[background.time_name] += np.repeat(self.bunch_offsets[bunches],
+                                                evt_n_hits)
+        hits[background.event_index_name] = np.repeat(dest_events, evt_n_hits)
+        return hits
+
+    def _overlay_hits(self, sig_hits, background, bkg_events, dest_events,
+                      bunches):
+        """
+        Returns a copy of the signal hit object with the background events
+        added, which take the keys of the signal events
+        """
+        mixed = copy.copy(sig_hits)
+        hits = self._gather_hits(background, bkg_events, dest_events, bunches)
+        mixed.add_hits(hits, use_host_keys=True)
+        return mixed
+
+    def overlay(self):
+        """
+        Returns a CyDetHits of the signal events with their background events
+        added
+        """
+        # Flatten the table into one entry per added background event
+        n_signal = self.signal.cdc.n_events
+        dest_events = np.repeat(np.arange(n_signal), self.n_bunches)
+        bunches = np.tile(np.arange(self.n_bunches), n_signal)
+        bkg_events = self.background_events.ravel()
+        bkg_cdc = self._get_background_cdc()
+        mixed_cdc = self._overlay_hits(self.signal.cdc, bkg_cdc, bkg_events,
+                                       dest_events, bunches)
+        mixed_cth = self.signal.cth
+        if isinstance(self.background, CyDetHits):
+            # Match the background and signal CTH events by key
+            bkg_cth = self.background.cth
+            cth_bkg_events = bkg_cth.get_event_slots(
+                bkg_cdc.get_event_keys()[bkg_events])
+            has_cth = cth_bkg_events >= 0
+            dest_keys = self.signal.cdc.get_event_keys()[dest_events]
+            # Create the CTH events of the signal events that have none, so
+            # that their background CTH hits are kept
+            sig_cth = copy.copy(self.signal.cth)
+            missing_keys = np.setdiff1d(dest_keys[has_cth],
+                                        sig_cth.get_event_keys())
+            if len(missing_keys):
+                sig_cth.add_events(missing_keys)
+            cth_dest_events = sig_cth.get_event_slots(dest_keys[has_cth])
+            mixed_cth = self._overlay_hits(sig_cth, bkg_cth,
+                                           cth_bkg_events[has_cth],
+                                           cth_dest_events,
+                                           bunches[has_cth])
+        return CyDetHits(mixed_cdc, mixed_cth)
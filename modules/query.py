@@ -0,0 +1,245 @@
+import re
+import numpy as np
+"""
+Composable selections of hits, evaluated as one boolean mask
+"""
+
+# Largest value set tested by direct comparison, beyond which a sorted search
+# is faster
+_MAX_DIRECT_VALUES = 8
+# Largest value set written into a reader selection
+_MAX_SELECTION_VALUES = 32
+
+def _format_value(value):
+    """
+    Returns a value as it is written in a ROOT selection string
+    """
+    value = np.asarray(value).item()
+    if isinstance(value, bool):
+        value = int(value)
+    return repr(value)
+
+def get_selection_names(selection):
+    """
+    Returns the names of the variables used in a ROOT selection string
+    """
+    # Skip the names of functions, which are followed by a bracket
+    return re.findall(r"[A-Za-z_][\w.]*\b(?!\s*\()", selection)
+
+def in_values(column, values):
+    """
+    Returns the boolean mask of the entries of the column equal to any of the
+    values.  Large sets of values are searched for in sorted order.
+
+    :param column: numpy array to test
+    :param values: single value or sequence of values
+    """
+    values = np.asarray(values).ravel()
+    if len(values) <= _MAX_DIRECT_VALUES:
+        mask = np.zeros(len(column), dtype=bool)
+        for value in values:
+            mask |= column == value
+        return mask
+    values = np.unique(values)
+    # Find where each entry would be in the values, then check it is there
+    places = np.searchsorted(values, column)
+    places = np.minimum(places, len(values) - 1)
+    return values[places] == column
+
+class HitPredicate(object):
+    """
+    Condition on one column of the hit data.  A hit passes if the column
+    equals any of the values, is greater than greater_than and is less than
+    less_than, where each condition is only applied if it is given.  If invert
+    is set, the hits that fail pass and vice versa.
+
+    Predicates are written as ROOT selection strings by to_selection, so that
+    they can be applied by the reader while the file is imported.
+    """
+    def __init__(self, variable, values=None, greater_than=None,
+                 less_than=None, invert=False, selection=None):
+        """
+        :param variable: name of the column
+        :param values: value or list of values the column must equal
+        :param greater_than: value the column must be greater than
+        :param less_than: value the column must be less than
+        :param invert: select the hits that fail the conditions instead
+        :param selection: ROOT selection string equivalent to this predicate,
+                          for predicates on columns that are not branches of
+                          the file, e.g. the flat geometry IDs
+        """
+        self.variable = variable
+        self.values = values
+        self.greater_than = greater_than
+        self.less_than = less_than
+        self.invert = invert
+        self.selection = selection
+
+    def _copy(self, **changes):
+        """
+        Returns a copy of the predicate with the given attributes changed
+        """
+        attributes = dict(variable=self.variable, values=self.values,
+                          greater_than=self.greater_than,
+                          less_than=self.less_than, invert=self.invert,
+                          selection=self.selection)
+        attributes.update(changes)
+        return HitPredicate(**attributes)
+
+    def __invert__(self):
+        selection = self.selection
+        if selection is not None:
+            selection = "!({})".format(selection)
+        return self._copy(invert=not self.invert, selection=selection)
+
+    def with_prefix(self, prefix):
+        """
+        Returns the predicate with the prefix added to the variable if it does
+        not have it already
+        """
+        if self.variable.startswith(prefix):
+            return self
+        return self._copy(variable=prefix + self.variable)
+
+    def to_selection(self, max_values=_MAX_SELECTION_VALUES):
+        """
+        Returns the predicate as a ROOT selection string, or None if it cannot
+        be written as one, i.e. if it tests more than max_values values
+        """
+        if self.selection is not None:
+            return self.selection
+        conditions = []
+        if self.values is not None:
+            values = np.asarray(self.values).ravel()
+            if len(values) > max_values:
+                return None
+            if len(values) == 0:
+                conditions.append("0")
+            else:
+                conditions.append("(" + " || ".join(
+                    "{} == {}".format(self.variable, _format_value(value))
+                    for value in values) + ")")
+        if self.greater_than is not None:
+            conditions.append("{} > {}".format(self.variable,
+                                               _format_value(self.greater_than)))
+        if self.less_than is not None:
+            conditions.append("{} < {}".format(self.variable,
+                                               _format_value(self.less_than)))
+        selection = " && ".join(conditions) if conditions else "1"
+        if self.invert:
+            selection = "!({})".format(selection)
+        return selection
+
+    def cache_key(self):
+        """
+        Returns a string that identifies the predicate in an ImportCache key
+        """
+        values = self.values
+        if values is not None:
+            values = np.asarray(values).tolist()
+        return "HitPredicate({!r}, {!r}, {!r}, {!r}, {!r}, {!r})".format(
+            self.variable, values, self.greater_than, self.less_than,
+            self.invert, self.selection)
+
+    def __repr__(self):
+        return "HitPredicate({!r}, values={!r}, greater_than={!r}, "\
+               "less_than={!r}, invert={!r})".format(self.variable,
+                                                     self.values,
+                                                     self.greater_than,
+                                                     self.less_than,
+                                                     self.invert)
+
+    def evaluate(self, these_hits, mask=None):
+        """
+        Returns the boolean mask of the hits that pass.  If a mask is given,
+        the result is combined into it in place with a logical and.
+
+        :param these_hits: hit data holding the column
+        :param mask: boolean mask to combine the result into
+        """
+        column = these_hits[self.variable]
+        this_mask = np.ones(len(column), dtype=bool)
+        if self.values is not None:
+            this_mask &= in_values(column, self.values)
+        if self.greater_than is not None:
+            this_mask &= column > self.greater_than
+        if self.less_than is not None:
+            this_mask &= column < self.less_than
+        if self.invert:
+            np.logical_not(this_mask, out=this_mask)
+        if mask is None:
+            return this_mask
+        mask &= this_mask
+        return mask
+
+class HitQuery(object):
+    """
+    Chain of predicates on the hits of a hit object, e.g.
+
+        hits.query().where(hits.time_name, greater_than=700, less_than=1620)\\
+                    .where(hits.edep_name, greater_than=0.)\\
+                    .events(good_event_numbers)\\
+                    .trim()
+
+    Nothing is evaluated until mask, filter or trim are called, which combine
+    all the predicates into one boolean mask and apply it once.
+    """
+    def __init__(self, hits, predicates=None):
+        """
+        :param hits: hit object to select the hits of
+        :param predicates: list of HitPredicate to start from
+        """
+        self.hits = hits
+        self.predicates = list(predicates) if predicates is not None else []
+
+    def where(self, variable, values=None, greater_than=None, less_than=None,
+              invert=False):
+        """
+        Add a predicate on the variable.  See HitPredicate.
+        """
+        return self.add(HitPredicate(variable, values=values,
+                                     greater_than=greater_than,
+                                     less_than=less_than, invert=invert))
+
+    def events(self, keys, invert=False):
+        """
+        Keep the hits of the events with these key values, i.e. event numbers
+        """
+        return self.where(self.hits.key_name, values=keys, invert=invert)
+
+    def add(self, predicate):
+        """
+        Add a predicate to the query
+        """
+        self.predicates.append(predicate)
+        return self
+
+    def mask(self, these_hits=None):
+        """
+        Returns the boolean mask of the hits that pass every predicate
+
+        :param these_hits: hit data to evaluate on, default is all the hits
+        """
+        if these_hits is None:
+            these_hits = self.hits.data
+        mask = np.ones(len(these_hits), dtype=bool)
+        for predicate in self.predicates:
+            predicate.evaluate(these_hits, mask)
+        return mask
+
+    def filter(self, these_hits=None):
+        """
+        Returns the hits that pass every predicate
+
+        :param these_hits: hit data to select from, default is all the hits
+        """
+        if these_hits is None:
+            these_hits = self.hits.data
+        return these_hits[self.mask(these_hits)]
+
+    def trim(self):
+        """
+        Keep only the hits that pass every predicate in the hit object
+        """
+        self.hits._keep_hits(self.mask()) # pylint: disable=protected-access
+        return self.hits
@@ -0,0 +1,283 @@
+import os
+import re
+import ast
+import json
+import numpy as np
+"""
+Readers that import branches from hit files as numpy structured arrays, one
+entry per row, in the format returned by root_numpy.root2array.  Branches
+holding a list per entry are object columns of numpy arrays.
+
+ - RootNumpyReader reads root files with root_numpy, and needs ROOT
+ - UprootReader reads root files with uproot, without needing ROOT
+ - NativeReader reads the directories written by FlatHits.save, where each
+   hit is one entry
+"""
+
+# Names of the branches in each (reader, file, tree), filled once per file
+_BRANCH_SCHEMAS = dict()
+
+def _get_branches_in(selection, names):
+    """
+    Returns the branch names used in the selection string
+    """
+    if selection is None:
+        return []
+    return [name for name in names
+            if re.search(r"(?<![\w.])" + re.escape(name) + r"(?![\w.])",
+                         selection)]
+
+# Operators allowed in selection strings, mapped to numpy functions
+_BIN_OPS = {ast.Add : np.add, ast.Sub : np.subtract, ast.Mult : np.multiply,
+            ast.Div : np.true_divide, ast.Mod : np.mod,
+            ast.RShift : np.right_shift, ast.LShift : np.left_shift,
+            ast.BitAnd : np.bitwise_and, ast.BitOr : np.bitwise_or,
+            ast.BitXor : np.bitwise_xor}
+_COMPARE_OPS = {ast.Lt : np.less, ast.LtE : np.less_equal,
+                ast.Gt : np.greater, ast.GtE : np.greater_equal,
+                ast.Eq : np.equal, ast.NotEq : np.not_equal}
+_FUNCTIONS = {"abs" : np.abs, "sqrt" : np.sqrt}
+
+def _eval_node(node, columns):
+    """
+    Evaluates a node of a parsed selection on the columns
+    """
+    # pylint: disable=too-many-return-statements
+    if isinstance(node, ast.Expression):
+        return _eval_node(node.body, columns)
+    if isinstance(node, ast.BoolOp):
+        values = [_eval_node(val, columns) for val in node.values]
+        if isinstance(node.op, ast.And):
+            return np.logical_and.reduce(values)
+        return np.logical_or.reduce(values)
+    if isinstance(node, ast.UnaryOp):
+        value = _eval_node(node.operand, columns)
+        if isinstance(node.op, ast.Not):
+            return np.logical_not(value)
+        if isinstance(node.op, ast.USub):
+            return np.negative(value)
+        if isinstance(node.op, ast.Invert):
+            return np.invert(value)
+        return value
+    if isinstance(node, ast.BinOp) and type(node.op) in _BIN_OPS:
+        return _BIN_OPS[type(node.op)](_eval_node(node.left, columns),
+                                       _eval_node(node.right, columns))
+    if isinstance(node, ast.Compare):
+        # Chained comparisons are the logical and of each comparison
+        left = _eval_node(node.left, columns)
+        result = True
+        for oper, right_node in zip(node.ops, node.comparators):
+            right = _eval_node(right_node, columns)
+            result = np.logical_and(result,
+                                    _COMPARE_OPS[type(oper)](left, right))
+            left = right
+        return result
+    if isinstance(node, ast.Name):
+        return columns[node.id]
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and\
+            node.func.id in _FUNCTIONS:
+        return _FUNCTIONS[node.func.id](*[_eval_node(arg, columns)
+                                          for arg in node.args])
+    raise ValueError("ERROR: Cannot evaluate {} in selection".format(
+        ast.dump(node)))
+
+def evaluate_selection(selection, columns):
+    """
+    Evaluates a ROOT style selection string, e.g.
+        "CDCHit.fDetectedTime < 1620 && CDCHit.fDetectedTime > 700"
+    on a dictionary of columns, returning the boolean mask of passing entries
+
+    :param selection: selection string using &&, ||, !, comparisons, and
+                      arithmetic and bitwise operators
+    :param columns: dictionary of branch name to numpy array
+    """
+    # Branch names contain dots, so replace them with placeholder names
+    names = sorted(columns, key=len, reverse=True)
+    placeholders = dict()
+    expression = selection
+    for idx, name in enumerate(names):
+        placeholder = "_branch_{}".format(idx)
+        expression, n_subs = re.subn(r"(?<![\w.])" + re.escape(name) +
+                                     r"(?![\w.])", placeholder, expression)
+        if n_subs:
+            placeholders[placeholder] = columns[name]
+    # Map the C++ logical operators onto python ones
+    expression = expression.replace("&&", " and ").replace("||", " or ")
+    expression = re.sub(r"!(?!=)", " not ", expression)
+    tree = ast.parse(expression.strip(), mode="eval")
+    mask = _eval_node(tree, placeholders)
+    n_entries = len(next(iter(columns.values()))) if columns else 0
+    return np.broadcast_to(np.asarray(mask, dtype=bool), (n_entries,))
+
+def _to_structured(columns, names):
+    """
+    Packs a dictionary of columns into a structured array in the order of
+    names, with list-per-entry columns stored as object arrays
+    """
+    n_entries = len(columns[names[0]]) if names else 0
+    dtype = [(name, columns[name].dtype) for name in names]
+    result = np.empty(n_entries, dtype=dtype)
+    for name in names:
+        result[name] = columns[name]
+    return result
+
+class Reader(object):
+    """
+    Base class of the hit file readers
+    """
+    name = None
+
+    def cache_key(self):
+        """
+        Returns a string that identifies the reader in an ImportCache key
+        """
+        return repr(self.name)
+
+    def list_branches(self, path, tree):
+        """
+        Returns the names of all the branches of the tree
+        """
+        raise NotImplementedError
+
+    def read(self, path, tree=None, branches=None, selection=None,
+             start=None, stop=None):
+        """
+        Returns the given branches of the entries in [start, stop) that pass
+        the selection, as a structured array
+
+        :param path: path to the file
+        :param tree: name of the tree, default is the only tree in the file
+        :param branches: branches to import, default is all of them
+        :param selection: ROOT style selection string
+        :param start: first entry to import
+        :param stop: entry to stop importing at
+        """
+        raise NotImplementedError
+
+    def get_branch_names(self, path, tree):
+        """
+        Returns the names of the branches availible in the tree, reading them
+        from the file the first time it is seen
+        """
+        # Key on the modification time as well so an overwritten file is
+        # re-read
+        key = (self.name, os.path.abspath(path), tree,
+               os.path.getmtime(path))
+        if key not in _BRANCH_SCHEMAS:
+            _BRANCH_SCHEMAS[key] = tuple(self.list_branches(path, tree))
+        return _BRANCH_SCHEMAS[key]
+
+class RootNumpyReader(Reader):
+    """
+    Reads root files through root_numpy.root2array
+    """
+    name = "root_numpy"
+
+    def list_branches(self, path, tree):
+        from root_numpy import root2array
+        # Importing zero entries builds the dtype without decoding any data
+        return root2array(path, treename=tree, start=0, stop=0).dtype.names
+
+    def read(self, path, tree=None, branches=None, selection=None,
+             start=None, stop=None):
+        from root_numpy import root2array
+        return root2array(path, treename=tree, branches=branches,
+                          selection=selection, start=start, stop=stop)
+
+class UprootReader(Reader):
+    """
+    Reads root files with uproot, which does not need a ROOT installation.
+    Selections are evaluated on the imported entries, and may only use
+    branches with one value per entry.
+    """
+    name = "uproot"
+
+    def _open_tree(self, path, tree):
+        import uproot
+        root_file = uproot.open(path)
+        if tree is None:
+            tree = root_file.keys(filter_classname="TTree", cycle=False)[0]
+        return root_file[tree]
+
+    def list_branches(self, path, tree):
+        return self._open_tree(path, tree).keys(recursive=True,
+                                                full_paths=False)
+
+    def read(self, path, tree=None, branches=None, selection=None,
+             start=None, stop=None):
+        this_tree = self._open_tree(path, tree)
+        all_names = self.get_branch_names(path, tree)
+        if branches is None:
+            branches = list(all_names)
+        if not isinstance(branches, list):
+            branches = [branches]
+        to_read = list(branches) + \
+                  [name for name in _get_branches_in(selection, all_names)
+                   if name not in branches]
+        # Filter by name so that dotted names are not read as expressions
+        arrays = this_tree.arrays(filter_name=to_read, library="np",
+                                  entry_start=start, entry_stop=stop)
+        columns = dict((name.split("/")[-1], arr)
+                       for name, arr in arrays.items())
+        if selection is not None:
+            mask = evaluate_selection(selection, columns)
+            columns = dict((name, arr[mask]) for name, arr in columns.items())
+        return _to_structured(columns, branches)
+
+class NativeReader(Reader):
+    """
+    Reads the directories written by FlatHits.save as a tree with one entry
+    per hit.  The tree argument is ignored.
+    """
+    name = "native"
+
+    def _read_metadata(self, path):
+        with open(os.path.join(path, "meta.json")) as meta_file:
+            return json.load(meta_file)
+
+    def list_branches(self, path, tree):
+        return self._read_metadata(path)["columns"]
+
+    def read(self, path, tree=None, branches=None, selection=None,
+             start=None, stop=None):
+        all_names = self._read_metadata(path)["columns"]
+        if branches is None:
+            branches = list(all_names)
+        if not isinstance(branches, list):
+            branches = [branches]
+        to_read = list(branches) + \
+                  [name for name in _get_branches_in(selection, all_names)
+                   if name not in branches]
+        # Memory map the columns so only the requested entries are read
+        columns = dict()
+        for name in to_read:
+            column_file = "column_{}.npy".format(all_names.index(name))
+            columns[name] = np.load(os.path.join(path, column_file),
+                                    mmap_mode="r")[start:stop]
+        if selection is not None:
+            mask = evaluate_selection(selection, columns)
+            columns = dict((name, arr[mask]) for name, arr in columns.items())
+        return _to_structured(columns, branches)
+
+# Readers by name
+READERS = {"root_numpy" : RootNumpyReader,
+           "uproot" : UprootReader,
+           "native" : NativeReader}
+
+def get_reader(reader=None):
+    """
+    Returns a reader instance.  The reader can be given by name, as an
+    instance, or as None for the default, which is root_numpy if it can be
+    imported and uproot otherwise.
+    """
+    if isinstance(reader, Reader):
+        return reader
+    if reader is None:
+        try:
+            import root_numpy # pylint: disable=unused-variable
+            reader = "root_numpy"
+        except ImportError:
+            reader = "uproot"
+    return READERS[reader]()
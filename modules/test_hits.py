@@ -0,0 +1,523 @@
+import os
+import json
+import shutil
+import contextlib
+import tempfile
+import numpy as np
+from hits import FlatHits, CDCHits, CTHHits, CyDetHits, concatenate_hits
+from overlay import EventOverlay
+
+"""
+Checks that the vectorized hit methods match the per-event logic they
+replaced, on small samples written in the format read by NativeReader
+"""
+
+def _write_sample(columns):
+    """
+    Writes the columns as a directory read by NativeReader, with one entry
+    per hit, and returns its path
+    """
+    path = tempfile.mkdtemp(prefix="test_hits_")
+    names = list(columns)
+    for col, name in enumerate(names):
+        np.save(os.path.join(path, "column_{}.npy".format(col)),
+                np.asarray(columns[name]))
+    with open(os.path.join(path, "meta.json"), "w") as meta_file:
+        json.dump({"columns" : names}, meta_file)
+    return path
+
+def _make_flat_sample(n_events=40, seed=0):
+    """
+    Returns a sample of hits with few distinct times, so that the sorts
+    have ties to break
+    """
+    rng = np.random.RandomState(seed)
+    evt_n_hits = rng.randint(1, 20, size=n_events)
+    n_hits = evt_n_hits.sum()
+    return _write_sample({
+        "CDCHit.fEventNumber" : np.repeat(3 * np.arange(n_events) + 1,
+                                          evt_n_hits),
+        "CDCHit.fIsSig" : rng.rand(n_hits) < 0.3,
+        "CDCHit.fDetectedTime" : rng.randint(0, 5, size=n_hits).astype(float),
+        "CDCHit.fCharge" : rng.randint(0, 3, size=n_hits).astype(float)})
+
+def _make_cdc_sample(n_events=40, seed=0, first_key=1, times=(500, 1700)):
+    """
+    Returns a sample of CDC hits with the event numbers first_key, then every
+    third number after it, and times drawn from the given range
+    """
+    rng = np.random.RandomState(seed)
+    n_wires = np.array([198, 204, 210, 216, 222, 228, 234, 240, 246,
+                        252, 258, 264, 270, 276, 282, 288, 294, 300])
+    evt_n_hits = rng.randint(5, 40, size=n_events)
+    n_hits = evt_n_hits.sum()
+    layers = rng.randint(0, len(n_wires), size=n_hits)
+    return _write_sample({
+        "CDCHit.fEventNumber" : np.repeat(first_key + 3 * np.arange(n_events),
+                                          evt_n_hits),
+        "CDCHit.fIsSig" : rng.rand(n_hits) < 0.3,
+        "CDCHit.flayerID" : layers,
+        "CDCHit.fcellID" : (rng.rand(n_hits) * n_wires[layers]).astype(int),
+        "CDCHit.fCharge" : rng.rand(n_hits) * 100,
+        "CDCHit.fDetectedTime" : rng.randint(times[0], times[1],
+                                             size=n_hits).astype(float),
+        "CDCHit.fMCPos.fE" : rng.rand(n_hits)})
+
+def _make_cth_sample(n_events=40, seed=0):
+    """
+    Returns a sample of CTH hits where most events have a cluster of hits in
+    neighbouring counters, which may form a trigger pattern, on top of hits
+    spread over the hodoscope
+    """
+    rng = np.random.RandomState(seed)
+    hits = []
+    for event in range(n_events):
+        event_number = 3 * event + 1
+        # Cluster of hits in neighbouring counters of the same hodoscope
+        if rng.rand() < 0.7:
+            upstream = rng.randint(0, 2)
+            center = rng.randint(0, 64)
+            for _ in range(rng.randint(3, 9)):
+                bits = (upstream << 9) | (rng.randint(0, 2) << 1)
+                hits.append((event_number, rng.rand() < 0.5,
+                             (bits << 15) | rng.randint(0, 1 << 15),
+                             (center + rng.randint(-1, 2)) % 64,
+                             float(rng.randint(500, 1300)), rng.rand()))
+        # Hits anywhere, including the light guides
+        for _ in range(rng.randint(0, 12)):
+            bits = (rng.randint(0, 2) << 9) | (rng.randint(0, 2) << 1) | \
+                   rng.randint(0, 2)
+            hits.append((event_number, rng.rand() < 0.3,
+                         (bits << 15) | rng.randint(0, 1 << 15),
+                         rng.randint(0, 64), float(rng.randint(500, 1300)),
+                         rng.rand()))
+    names = ["CTHHit.fEventNumber", "CTHHit.fIsSig", "CTHHit.fChannel",
+             "CTHHit.fCounter", "CTHHit.fMCPos.fE", "CTHHit.fCharge"]
+    return _write_sample(dict((name, np.array([hit[col] for hit in hits]))
+                              for col, name in enumerate(names)))
+
+def _reference_trigger_signal(geom, vol_types):
+    """
+    Returns the volumes of one event that form a trigger pattern, as
+    CTHHits._find_trigger_signal did before it took many events at once
+    """
+    hit_and_left = np.logical_and(vol_types, vol_types[geom.shift_wires(1)])
+    hit_and_right = np.logical_and(vol_types, vol_types[geom.shift_wires(-1)])
+    trig_crys = np.logical_or(hit_and_left, hit_and_right)
+    on_top = np.logical_and(trig_crys[geom.cher_crys],
+                            trig_crys[geom.scin_crys])
+    trig_crys[geom.cher_crys] = on_top
+    trig_crys[geom.scin_crys] = on_top
+    trig_crys = np.logical_or.reduce((trig_crys,
+                                      trig_crys[geom.shift_wires(1)],
+                                      trig_crys[geom.shift_wires(-1)]))
+    return np.logical_and(vol_types, trig_crys)
+
+def _reference_trigger_times(hits):
+    """
+    Returns the trigger time of each hit of time sorted data, found event by
+    event as set_trigger_time did before it was vectorized
+    """
+    flat_ids = hits.data[hits.flat_name]
+    trig_times = np.zeros(hits.n_hits)
+    for event in range(hits.n_events):
+        evt_hits = hits.get_hit_indexes(event)
+        vol_types = np.zeros(hits.geom.n_points, dtype=bool)
+        vol_types[flat_ids[evt_hits]] = True
+        trig_vols = np.flatnonzero(_reference_trigger_signal(hits.geom,
+                                                             vol_types))
+        trig_hits = evt_hits[np.in1d(flat_ids[evt_hits], trig_vols)]
+        # Take the first appearance of a volume at or after the fourth hit
+        _, uniq_idxs = np.unique(flat_ids[trig_hits], return_index=True)
+        uniq_idxs = uniq_idxs[uniq_idxs > 2]
+        if len(uniq_idxs) == 0:
+            continue
+        trig_times[trig_hits] = hits.data[hits.time_name][
+            trig_hits[uniq_idxs.min()]]
+    return trig_times
+
+def _reference_sort(hits, variable, ascending=True):
+    """
+    Returns the hit data sorted event by event as a record array, as
+    sort_hits did before it was vectorized
+    """
+    records = hits.data.to_records()
+    for event in range(hits.n_events):
+        evt_hits = hits.get_hit_indexes(event)
+        sort_order = records[evt_hits].argsort(order=variable)
+        if not ascending:
+            sort_order = sort_order[::-1]
+        records[evt_hits] = records[evt_hits][sort_order]
+    return records
+
+def _reference_merge(hits, added, dest_events, merge_on):
+    """
+    Returns the hit data with the added hits merged in as a record array,
+    and the event of each hit, by stacking the hits and stable sorting them by
+    event then by merge_on, so that existing hits stay ahead of added hits
+    they tie with
+    """
+    records = np.concatenate([hits.data.to_records(), added.to_records()])
+    hit_events = np.concatenate([np.repeat(np.arange(hits.n_events),
+                                           hits.event_to_n_hits),
+                                 dest_events])
+    if merge_on is None:
+        order = np.argsort(hit_events, kind="stable")
+    else:
+        order = np.lexsort((records[merge_on], hit_events))
+    return records[order], hit_events[order]
+
+def test_sort_hits_matches_event_loop():
+    """
+    Sorting all events with one lexsort gives the same order as sorting
+    each event on its own, including how ties are broken
+    """
+    path = _make_flat_sample()
+    try:
+        for variable in ["CDCHit.fDetectedTime",
+                         ["CDCHit.fCharge", "CDCHit.fDetectedTime"]]:
+            for ascending in [True, False]:
+                hits = FlatHits(path, reader="native",
+                                branches=["DetectedTime", "Charge"])
+                expected = _reference_sort(hits, variable, ascending)
+                hits.sort_hits(variable, ascending=ascending,
+                               reset_index=False)
+                for name in hits.data.names:
+                    assert np.array_equal(hits.data[name], expected[name]),\
+                        "{} differs sorting by {}".format(name, variable)
+    finally:
+        shutil.rmtree(path)
+
+def test_trim_events_keeps_every_event_with_a_key():
+    """
+    Trimming by key through the sorted key index keeps the same hits as
+    testing the key of every hit, including when events share a key after
+    combining samples without rebasing their keys
+    """
+    path = _make_flat_sample()
+    try:
+        hits = concatenate_hits([FlatHits(path, reader="native",
+                                          branches=["DetectedTime"]),
+                                 FlatHits(path, reader="native",
+                                          branches=["DetectedTime"])])
+        hit_keys = hits.data[hits.key_name]
+        rng = np.random.RandomState(1)
+        # Ask for some keys twice and some keys that are not in the data
+        keys = rng.choice(np.append(np.unique(hit_keys), [-5, 1000]), 25)
+        expected = hits.data[np.in1d(hit_keys, keys)]
+        hits.trim_events(keys)
+        for name in [hits.key_name, "CDCHit.fDetectedTime"]:
+            assert np.array_equal(hits.data[name], expected[name])
+        # Trim again through the index kept from the first trim
+        keys = rng.choice(keys, 10)
+        expected = hits.data[np.in1d(hits.data[hits.key_name], keys)]
+        hits.trim_events(keys)
+        assert np.array_equal(hits.data[hits.key_name],
+                              expected[hits.key_name])
+        assert hits.n_events == 2 * len(np.intersect1d(keys, hit_keys))
+    finally:
+        shutil.rmtree(path)
+
+def test_get_event_slots_matches_key_search():
+    """
+    The event of each key found through the sorted key index is the first
+    event with that key, or -1 if there is none
+    """
+    path = _make_flat_sample()
+    try:
+        hits = concatenate_hits([FlatHits(path, reader="native",
+                                          branches=["DetectedTime"]),
+                                 FlatHits(path, reader="native",
+                                          branches=["DetectedTime"])])
+        hits.trim_hits("CDCHit.fDetectedTime", less_than=3)
+        event_keys = hits.get_event_keys()
+        keys = np.array([event_keys[-1], -5, event_keys[0], 1000,
+                         event_keys[3]])
+        expected = [np.flatnonzero(event_keys == key)[0]
+                    if key in event_keys else -1 for key in keys]
+        assert np.array_equal(hits.get_event_slots(keys), expected)
+        all_slots = hits.get_event_slots(keys, all_events=True)
+        expected = np.concatenate([np.flatnonzero(event_keys == key)
+                                   for key in keys])
+        assert np.array_equal(all_slots, expected)
+    finally:
+        shutil.rmtree(path)
+
+def test_set_trigger_time_matches_event_loop():
+    """
+    Finding the trigger patterns of all events at once gives the same
+    trigger times as finding them event by event, also when the occupancy is
+    built in several blocks of events
+    """
+    path = _make_cth_sample()
+    try:
+        hits = CTHHits(path, reader="native")
+        hits.sort_hits(hits.time_name)
+        expected = _reference_trigger_times(hits)
+        assert (expected != 0).any(), "sample has no triggered events"
+        hits.set_trigger_time()
+        assert np.array_equal(hits.data[hits.trig_name], expected)
+        hit_events = np.repeat(np.arange(hits.n_events), hits.event_to_n_hits)
+        assert np.array_equal(hits._get_trigger_hits(hit_events,
+                                                     events_per_block=7),
+                              hits._get_trigger_hits(hit_events))
+    finally:
+        shutil.rmtree(path)
+
+def test_trigger_time_after_adding_hits_with_other_keys():
+    """
+    Adding earlier hits with other keys to the CDC events does not change the
+    keys of the events, so each event still takes the trigger time of the
+    CTH event with its key
+    """
+    paths = [_make_cdc_sample(seed=2), _make_cth_sample(),
+             _make_cdc_sample(seed=3, first_key=1001, times=(0, 400))]
+    try:
+        hits = CyDetHits(CDCHits(paths[0], reader="native"),
+                         CTHHits(paths[1], reader="native"))
+        hits.keep_common_events()
+        background = CDCHits(paths[2], reader="native")
+        background.trim_events(
+            background.get_event_keys()[:hits.cdc.n_events])
+        event_keys = hits.cdc.get_event_keys().copy()
+        hits.cdc.add_hits(background.data)
+        assert np.array_equal(hits.cdc.get_event_keys(), event_keys)
+        hits.set_trigger_time()
+        cth_times = dict(zip(hits.cth.get_event_keys(),
+                             np.nan_to_num(
+                                 hits.cth.get_event_trigger_times())))
+        assert any(cth_times.values()), "sample has no triggered events"
+        expected = np.repeat([cth_times[key] for key in event_keys],
+                             hits.cdc.event_to_n_hits)
+        assert np.array_equal(hits.cdc.data[hits.cdc.trig_name], expected)
+    finally:
+        for path in paths:
+            shutil.rmtree(path)
+
+def test_add_hits_matches_stacked_sort():
+    """
+    Merging hits into each event gives the same hits as stacking them and
+    sorting by event and time, for added events sent to events out of order
+    and more than once, and for unsorted data where the added hits go last
+    """
+    paths = [_make_cdc_sample(seed=4), _make_cdc_sample(seed=5, first_key=2,
+                                                        n_events=25),
+             _make_flat_sample(seed=6), _make_flat_sample(seed=7,
+                                                          n_events=15)]
+    try:
+        rng = np.random.RandomState(8)
+        for hit_class, host_path, added_path in [(CDCHits, *paths[:2]),
+                                                 (FlatHits, *paths[2:])]:
+            for use_host_keys in [False, True]:
+                hits = hit_class(host_path, reader="native",
+                                 branches=["DetectedTime"])
+                added = hit_class(added_path, reader="native",
+                                  branches=["DetectedTime"])
+                event_indexes = rng.choice(hits.n_events, added.n_events)
+                dest_events = event_indexes[
+                    added.data[added.event_index_name]]
+                merge_on = hits.time_name if hit_class is CDCHits else None
+                event_keys = hits.get_event_keys().copy()
+                expected, hit_events = _reference_merge(hits, added.data,
+                                                        dest_events, merge_on)
+                if use_host_keys:
+                    expected[hits.key_name] = event_keys[hit_events]
+                hits.add_hits(added, event_indexes=event_indexes,
+                              use_host_keys=use_host_keys)
+                assert np.array_equal(hits.get_event_keys(), event_keys)
+                for name in hits.data.names:
+                    if name in [hits.hits_index_name, hits.event_index_name]:
+                        continue
+                    assert np.array_equal(hits.data[name], expected[name]),\
+                        "{} differs after the merge".format(name)
+    finally:
+        for path in paths:
+            shutil.rmtree(path)
+
+def test_min_layer_cut_returns_event_keys_after_merge():
+    """
+    The events passing the layer cut are found by the key of each event,
+    also after adding hits with other keys, so trimming to them keeps the
+    passing events
+    """
+    paths = [_make_cdc_sample(seed=9, n_events=30),
+             _make_cdc_sample(seed=10, first_key=1001, n_events=30,
+                              times=(0, 400))]
+    try:
+        hits = CDCHits(paths[0], reader="native")
+        event_keys = hits.get_event_keys().copy()
+        hits.add_hits(CDCHits(paths[1], reader="native"))
+        hit_layers = hits.geom.point_layers[hits.data[hits.flat_name]]
+        passed = [hit_layers[hits.get_hit_indexes(event)].max() >= 17
+                  for event in range(hits.n_events)]
+        expected = np.unique(event_keys[passed])
+        assert 0 < len(expected) < hits.n_events
+        assert np.array_equal(hits.min_layer_cut(17), expected)
+        hits.trim_events(hits.min_layer_cut(17))
+        assert hits.n_events == len(expected)
+    finally:
+        for path in paths:
+            shutil.rmtree(path)
+
+def test_sort_and_trigger_inside_batch_trims():
+    """
+    Sorting the hits and setting the trigger time inside batch_trims, after
+    trims that remove whole events, gives the same hits as outside a batch
+    """
+    path = _make_cth_sample()
+    try:
+        all_hits = [CTHHits(path, reader="native") for _ in range(2)]
+        for hits in all_hits:
+            hits.sort_hits(hits.edep_name)
+        for in_batch, hits in enumerate(all_hits):
+            with hits.batch_trims() if in_batch else contextlib.nullcontext():
+                hits.trim_events(hits.get_event_keys()[1::3])
+                hits.trim_hits(hits.time_name, less_than=1100)
+                hits.sort_hits(hits.time_name, ascending=False)
+                hits.set_trigger_time()
+                trig_evts = hits.get_trig_evts()
+        assert np.array_equal(all_hits[0].get_trig_evts(), trig_evts)
+        for name in all_hits[0].data.names:
+            assert np.array_equal(all_hits[0].data[name],
+                                  all_hits[1].data[name]), name
+    finally:
+        shutil.rmtree(path)
+
+def test_overlay_keeps_every_background_hit():
+    """
+    The mixed sample holds the signal hits and the hits of the chosen
+    background events in each detector, including the background CTH hits
+    added to signal events that had no CTH hits
+    """
+    paths = [_make_cdc_sample(seed=11), _make_cth_sample(n_events=20),
+             _make_cdc_sample(seed=12, n_events=30),
+             _make_cth_sample(n_events=30, seed=13)]
+    try:
+        signal = CyDetHits(CDCHits(paths[0], reader="native"),
+                           CTHHits(paths[1], reader="native"))
+        background = CyDetHits(CDCHits(paths[2], reader="native"),
+                               CTHHits(paths[3], reader="native"))
+        overlay = EventOverlay(signal, background, n_bunches=2,
+                               bunch_offsets=[0, 100], seed=1)
+        mixed = overlay.overlay()
+        bkg_events = overlay.background_events
+        bkg_keys = background.cdc.get_event_keys()[bkg_events]
+        # Count the hits of the background CTH events with each key
+        cth_n_hits = dict(zip(background.cth.get_event_keys(),
+                              background.cth.event_to_n_hits))
+        bkg_cth_n_hits = np.vectorize(lambda key: cth_n_hits.get(key, 0))(
+            bkg_keys)
+        assert mixed.cdc.n_hits == signal.cdc.n_hits + \
+            background.cdc.event_to_n_hits[bkg_events].sum()
+        assert mixed.cth.n_hits == signal.cth.n_hits + bkg_cth_n_hits.sum()
+        # Each mixed CTH event has the hits of its signal and background
+        # events
+        sig_n_hits = dict(zip(signal.cth.get_event_keys(),
+                              signal.cth.event_to_n_hits))
+        for event, key in enumerate(signal.cdc.get_event_keys()):
+            expected = sig_n_hits.get(key, 0) + bkg_cth_n_hits[event].sum()
+            slot = mixed.cth.get_event_slots(key)[0]
+            n_hits = mixed.cth.event_to_n_hits[slot] if slot >= 0 else 0
+            assert n_hits == expected, key
+    finally:
+        for path in paths:
+            shutil.rmtree(path)
+
+def test_merge_lazy_and_eager_hits():
+    """
+    Hits imported with a lazy branch can be merged with, and concatenated
+    with, hits imported without lazy branches, in either order
+    """
+    path = _make_cdc_sample(seed=14)
+    try:
+        eager = CDCHits(path, reader="native", branches=["MCPos.fE"])
+        expected = np.sort(np.tile(eager.data["CDCHit.fMCPos.fE"], 2))
+        for lazy in [[True, False], [False, True]]:
+            all_hits = [CDCHits(path, reader="native", branches=["MCPos.fE"],
+                                lazy=is_lazy) for is_lazy in lazy]
+            combined = concatenate_hits(all_hits)
+            assert np.array_equal(np.sort(combined.data["CDCHit.fMCPos.fE"]),
+                                  expected)
+            all_hits = [CDCHits(path, reader="native", branches=["MCPos.fE"],
+                                lazy=is_lazy) for is_lazy in lazy]
+            all_hits[0].add_hits(all_hits[1])
+            assert np.array_equal(
+                np.sort(all_hits[0].data["CDCHit.fMCPos.fE"]), expected)
+            assert all_hits[0].data.names == combined.data.names
+    finally:
+        shutil.rmtree(path)
+
+def test_trim_time_window_sorted_matches_mask():
+    """
+    Trimming to a time window per event through the time sorted hits keeps
+    the same hits as comparing every hit to its window, including windows
+    with NaN edges and windows with the edges the wrong way round
+    """
+    path = _make_cdc_sample(seed=15)
+    try:
+        rng = np.random.RandomState(16)
+        n_events = CDCHits(path, reader="native").n_events
+        lower = rng.randint(500, 1100, size=n_events).astype(float)
+        upper = lower + rng.randint(-100, 600, size=n_events)
+        lower[::5] = np.nan
+        upper[1::7] = np.nan
+        for edges in [(lower, upper), (lower, None), (None, upper),
+                      (lower, 1200.)]:
+            all_hits = [CDCHits(path, reader="native") for _ in range(2)]
+            # Use the mask path on the second object
+            all_hits[1]._sorted_by = []
+            for hits in all_hits:
+                hits.trim_time_window(*edges)
+            for name in [all_hits[0].time_name, all_hits[0].key_name]:
+                assert np.array_equal(all_hits[0].data[name],
+                                      all_hits[1].data[name])
+            assert 0 < all_hits[0].n_hits
+    finally:
+        shutil.rmtree(path)
+
+def test_concatenate_hits_leaves_inputs_unchanged():
+    """
+    Changing the branches of concatenated hits does not change the hit
+    objects they were made from
+    """
+    path = _make_cdc_sample(seed=17)
+    try:
+        all_hits = [CDCHits(path, reader="native", branches=["MCPos.fE"])
+                    for _ in range(2)]
+        branches = list(all_hits[0].all_branches)
+        names = all_hits[0].data.names
+        combined = concatenate_hits(all_hits)
+        combined.remove_branch("MCPos.fE")
+        combined.add_bitmap_index(combined.layer_name)
+        assert all_hits[0].all_branches == branches
+        assert all_hits[0].data.names == names
+        assert combined.layer_name not in all_hits[0].bitmap_names
+    finally:
+        shutil.rmtree(path)
+
+def test_cydet_event_view_matches_events_by_key():
+    """
+    The CTH hits paired with each CDC event have the key of that event, also
+    after the CTH events are trimmed on their own
+    """
+    paths = [_make_cdc_sample(seed=18), _make_cth_sample(seed=19)]
+    try:
+        hits = CyDetHits(CDCHits(paths[0], reader="native"),
+                         CTHHits(paths[1], reader="native"))
+        hits.cth.trim_events(hits.cth.get_event_keys()[::2])
+        cth_keys = set(hits.cth.get_event_keys())
+        n_paired = 0
+        for event, (cdc_hits, cth_hits) in enumerate(hits.iter_events()):
+            key = hits.cdc.get_event_keys()[event]
+            assert np.all(cdc_hits[hits.cdc.key_name] == key)
+            assert np.all(cth_hits[hits.cth.key_name] == key)
+            assert (len(cth_hits) > 0) == (key in cth_keys)
+            n_paired += len(cth_hits) > 0
+        assert n_paired == len(cth_keys)
+        cdc_hits, cth_hits = hits[3:9]
+        assert np.array_equal(np.unique(cth_hits[hits.cth.key_name]),
+                              np.intersect1d(hits.cdc.get_event_keys()[3:9],
+                                             list(cth_keys)))
+    finally:
+        for path in paths:
+            shutil.rmtree(path)